@@ -81,14 +81,47 @@ class SPM_Import_Operator(bpy.types.Operator, ImportHelper):
     extra_tex_path = bpy.props.StringProperty(
         name="Texture path(s)", description="Extra directory for textures, separate by ;;"
     )
+    weld_vertices = bpy.props.BoolProperty(name="Merge vertices at the same position", default=True)
+    files = bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
+    directory = bpy.props.StringProperty(subtype="DIR_PATH", options={'HIDDEN', 'SKIP_SAVE'})
+    whole_directory = bpy.props.BoolProperty(name="Import every SPM file in the folder", default=False)
+    group_per_file = bpy.props.BoolProperty(name="Group the objects of each file", default=False)
+    import_processes = bpy.props.IntProperty(
+        name="Processes decoding large imports (0 for one per core)", default=1, min=0
+    )
+    object_layout = bpy.props.EnumProperty(
+        name="Objects",
+        items=(
+            ("BUFFER", "One per mesh buffer", "Every mesh buffer of every sector becomes an object"),
+            ("MATERIAL", "One per material", "Merge the mesh buffers sharing a material"),
+            ("MERGED", "One per file", "Merge all mesh buffers, with a material slot per material")
+        ),
+        default="BUFFER"
+    )
 
     def draw(self, context):
         layout = self.layout
         layout.prop(self, "extra_tex_path")
+        layout.prop(self, "weld_vertices")
+        layout.prop(self, "whole_directory")
+        layout.prop(self, "group_per_file")
+        layout.prop(self, "import_processes")
+        layout.prop(self, "object_layout")
 
     def execute(self, context):
-        keywords = self.as_keywords(ignore=("filter_glob", ))
-        spm_import.load(context, **keywords)
+        directory = self.directory if self.directory else os.path.dirname(self.filepath)
+        if self.whole_directory:
+            names = [name for name in sorted(os.listdir(directory)) if name.lower().endswith(".spm")]
+            filepaths = [os.path.join(directory, name) for name in names]
+        else:
+            filepaths = [os.path.join(directory, f.name) for f in self.files if f.name]
+            if not filepaths:
+                filepaths = [self.filepath]
+
+        spm_import.load_files(
+            context, filepaths, self.extra_tex_path, self.weld_vertices, self.group_per_file, self.import_processes,
+            self.object_layout
+        )
         context.scene.update()
         return {"FINISHED"}
 
@@ -104,12 +137,40 @@ class SPM_Export_Operator(bpy.types.Operator):
     localsp = bpy.props.BoolProperty(name="Use local coordinates", default=False)
     applymodifiers = bpy.props.BoolProperty(name="Apply modifiers", default=True)
     do_sp = bpy.props.BoolProperty(name="Do mesh splitting (for space partitioning)", default=False)
+    sp_partition = bpy.props.EnumProperty(
+        name="Space partitioning",
+        items=(
+            ("GRID", "Grid", "Split into cubic sectors of a fixed size"),
+            ("OCTREE", "Octree", "Split recursively until sectors hold few enough triangles")
+        ),
+        default="GRID"
+    )
+    sp_sector_size = bpy.props.FloatProperty(name="Grid sector size", default=100.0, min=1.0)
+    sp_sector_triangles = bpy.props.IntProperty(name="Octree triangles per sector", default=10000, min=1)
     overwrite_without_asking = bpy.props.BoolProperty(name="Overwrite without asking", default=False)
     keyframes_only = bpy.props.BoolProperty(name="Export keyframes only for animated mesh", default=True)
     export_normal = bpy.props.BoolProperty(name="Export normal in mesh", default=True)
     export_vcolor = bpy.props.BoolProperty(name="Export vertex color in mesh", default=True)
     export_tangent = bpy.props.BoolProperty(name="Calculate tangent and bitangent sign for mesh", default=True)
     static_mesh_frame = bpy.props.IntProperty(name="Frame for static mesh usage", default=-1)
+    keyframe_tolerance = bpy.props.FloatProperty(
+        name="Drop keyframes interpolation reproduces within this tolerance (0 keeps all)", default=0.0, min=0.0
+    )
+    optimize_mesh = bpy.props.BoolProperty(name="Optimize mesh buffers for the vertex cache", default=False)
+    morton_order = bpy.props.BoolProperty(name="Keep mesh buffers spatially compact (Morton order)", default=False)
+    prune_attributes = bpy.props.BoolProperty(
+        name="Drop vertex colors no material needs",
+        description="Drops the vertex colors when they are all white. Normals, tangents and the second uv set are "
+        "always kept, a second uv set identical to the first one is only reported",
+        default=False
+    )
+    encode_processes = bpy.props.IntProperty(
+        name="Processes encoding large exports (0 for one per core)", default=1, min=0
+    )
+    cache_dir = bpy.props.StringProperty(name="SPM cache folder (empty to disable)", subtype="DIR_PATH", default="")
+    cache_size = bpy.props.IntProperty(name="SPM cache size (MB, 0 to disable)", default=512, min=0)
+    native_spm = bpy.props.BoolProperty(name="Use make_spm if available, not when exporting tangents", default=False)
+    native_spm_binary = bpy.props.StringProperty(name="make_spm binary", subtype="FILE_PATH", default="")
 
     def invoke(self, context, event):
         blend_filepath = context.blend_data.filepath
@@ -133,7 +194,19 @@ class SPM_Export_Operator(bpy.types.Operator):
             "export-vcolor": self.export_vcolor,
             "export-tangent": self.export_tangent,
             "static-mesh-frame": self.static_mesh_frame,
-            "do-sp": self.do_sp
+            "keyframe-tolerance": self.keyframe_tolerance,
+            "do-sp": self.do_sp,
+            "sp-partition": self.sp_partition,
+            "sp-sector-size": self.sp_sector_size,
+            "sp-sector-triangles": self.sp_sector_triangles,
+            "optimize-mesh": self.optimize_mesh,
+            "morton-order": self.morton_order,
+            "prune-attributes": self.prune_attributes,
+            "encode-processes": self.encode_processes,
+            "cache-dir": bpy.path.abspath(self.cache_dir) if self.cache_dir else "",
+            "cache-size": self.cache_size,
+            "native-spm": self.native_spm,
+            "native-spm-binary": self.native_spm_binary
         }
 
         if self.filepath == "":
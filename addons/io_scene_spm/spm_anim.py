@@ -0,0 +1,136 @@
+#!BPY
+
+# Copyright (c) 2017 SPM author(s)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Armature animation processing shared by the SPM exporter, works on plain
+# NumPy arrays only so it does not depend on bpy
+
+import numpy as np
+
+# Below this angle between two rotations slerp falls back to lerp
+SLERP_EPSILON = 1e-6
+
+
+def slerp(q0, q1, t):
+    """
+    Spherical interpolation of unit quaternions, taking the shortest path
+    :param q0: (..., 4)
+    :param q1: (..., 4)
+    :param t: (...) interpolation factors
+    :return: (..., 4)
+    """
+    t = np.asarray(t, dtype=np.float64)[..., None]
+    dot = np.sum(q0 * q1, axis=-1, keepdims=True)
+    q1 = np.where(dot < 0.0, -q1, q1)
+    dot = np.clip(np.abs(dot), 0.0, 1.0)
+    theta = np.arccos(dot)
+    sin_theta = np.sin(theta)
+    small = sin_theta < SLERP_EPSILON
+    safe_sin = np.where(small, 1.0, sin_theta)
+    w0 = np.where(small, 1.0 - t, np.sin((1.0 - t) * theta) / safe_sin)
+    w1 = np.where(small, t, np.sin(t * theta) / safe_sin)
+    return w0 * q0 + w1 * q1
+
+
+def interpolate_locRotScale(lrs0, lrs1, t):
+    """
+    Interpolate SPM location, rotation and scale like the game does between
+    two keyframes: linear for location and scale, slerp for rotation
+    :param lrs0: (..., 10) location xyz, rotation xyzw and scale xyz
+    :param lrs1: (..., 10)
+    :param t: (...) interpolation factors
+    :return: (..., 10)
+    """
+    t = np.asarray(t, dtype=np.float64)
+    result = lrs0 + (lrs1 - lrs0) * t[..., None]
+    result[..., 3:7] = slerp(lrs0[..., 3:7], lrs1[..., 3:7], t)
+    return result
+
+
+def locRotScale_error(lrs0, lrs1):
+    """
+    Largest absolute difference of any location, rotation or scale value,
+    a quaternion and its negation are the same rotation
+    :param lrs0: (..., 10)
+    :param lrs1: (..., 10)
+    :return: float
+    """
+    if lrs0.size == 0:
+        return 0.0
+    rotation = np.minimum(
+        np.abs(lrs0[..., 3:7] - lrs1[..., 3:7]).max(axis=-1),
+        np.abs(lrs0[..., 3:7] + lrs1[..., 3:7]).max(axis=-1)
+    )
+    return max(
+        float(np.abs(lrs0[..., 0:3] - lrs1[..., 0:3]).max()), float(rotation.max()),
+        float(np.abs(lrs0[..., 7:10] - lrs1[..., 7:10]).max())
+    )
+
+
+def decimate_keyframes(frames, lrs, tolerance):
+    """
+    Greedily drop keyframes which can be reconstructed by interpolating the
+    kept neighbours, every bone of every dropped frame stays within tolerance.
+    Every kept segment is checked as a whole, so the bound holds even though
+    the search may stop short of the longest segment that fits
+    :param frames: sorted frame numbers
+    :param lrs: (frame count, bone count, 10) location, rotation and scale
+    :param tolerance: largest error allowed by locRotScale_error
+    :return: list of kept rows, always including the first and last one
+    """
+    frames = np.asarray(frames, dtype=np.float64)
+    lrs = np.asarray(lrs, dtype=np.float64)
+    if len(frames) < 3:
+        return list(range(0, len(frames)))
+
+    def fits(start, end):
+        between = np.arange(start + 1, end)
+        t = (frames[between] - frames[start]) / (frames[end] - frames[start])
+        t = np.broadcast_to(t[:, None], (len(between), lrs.shape[1]))
+        reconstructed = interpolate_locRotScale(lrs[start][None], lrs[end][None], t)
+        return locRotScale_error(reconstructed, lrs[between]) <= tolerance
+
+    # Each segment is grown with an exponential search then narrowed down
+    # with a binary search, so only O(log length) windows are interpolated
+    # per kept frame instead of one per frame in the segment
+    kept = [0]
+    start = 0
+    last = len(frames) - 1
+    while start < last:
+        good = start + 1
+        bad = last + 1
+        step = 1
+        while good < last:
+            end = min(good + step, last)
+            if not fits(start, end):
+                bad = end
+                break
+            good = end
+            step *= 2
+        while bad - good > 1:
+            end = (good + bad) // 2
+            if fits(start, end):
+                good = end
+            else:
+                bad = end
+        kept.append(good)
+        start = good
+    return kept
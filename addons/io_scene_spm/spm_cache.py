@@ -0,0 +1,132 @@
+#!BPY
+
+# Copyright (c) 2017 SPM author(s)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Persistent content addressed cache of exported SPM files, an export whose
+# key was seen before is copied from the cache instead of being encoded again.
+# Entries are evicted least recently used first once the cache grows over its
+# size limit. Does not depend on bpy, the exporter computes the keys.
+
+import hashlib
+import os
+import os.path
+import shutil
+
+# Bump whenever the exporter output changes so older entries are not reused
+CACHE_VERSION = 1
+
+
+def new_key_hasher(export_settings, input_files=()):
+    """
+    Hasher seeded with the cache version, all export settings except the
+    cache ones and the content of input_files, the exporter feeds the objects
+    into it
+    :param export_settings:
+    :param input_files: files the export reads besides the objects, a missing
+                        file hashes differently from an empty one
+    :return: hashlib object
+    """
+    hasher = hashlib.sha1()
+    settings = sorted((key, value) for key, value in export_settings.items() if not key.startswith("cache-"))
+    hasher.update(str.encode(repr((CACHE_VERSION, settings))))
+    for path in input_files:
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            hasher.update(str.encode(repr((os.path.basename(path), len(content)))))
+            hasher.update(content)
+        except OSError:
+            hasher.update(str.encode(repr((os.path.basename(path), None))))
+    return hasher
+
+
+class SPMCache:
+
+    def __init__(self, directory, max_size):
+        """
+        :param directory: created on first store
+        :param max_size: in bytes
+        """
+        self.m_directory = directory
+        self.m_max_size = max_size
+
+    def get_path(self, key):
+        return os.path.join(self.m_directory, key + ".spm")
+
+    def restore(self, key, filename):
+        """
+        Copy the entry of key to filename if there is one
+        :param key:
+        :param filename:
+        :return: True on a hit
+        """
+        path = self.get_path(key)
+        if not os.path.isfile(path):
+            return False
+        temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            shutil.copyfile(path, temp_filename)
+            os.replace(temp_filename, filename)
+            # Mark as recently used
+            os.utime(path)
+        except OSError as e:
+            print("Failed to restore {} from the SPM cache: {}".format(filename, e))
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            return False
+        return True
+
+    def store(self, key, filename):
+        """
+        Add an exported file under key and evict old entries
+        :param key:
+        :param filename:
+        :return:
+        """
+        path = self.get_path(key)
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            os.makedirs(self.m_directory, exist_ok=True)
+            shutil.copyfile(filename, temp_path)
+            os.replace(temp_path, path)
+            self.evict()
+        except OSError as e:
+            print("Failed to store {} in the SPM cache: {}".format(filename, e))
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in its
+        size limit
+        :return:
+        """
+        entries = []
+        for entry in os.scandir(self.m_directory):
+            if entry.name.endswith(".spm") and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.m_max_size:
+                break
+            os.remove(path)
+            total_size -= size
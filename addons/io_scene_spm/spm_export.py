@@ -24,9 +24,18 @@ import bpy
 import sys
 import os
 import os.path
+import shutil
 import struct
+import subprocess
 import mathutils
 import bmesh
+import numpy as np
+
+from . import spm_anim
+from . import spm_mesh
+from . import spm_pool
+from .spm_cache import SPMCache, new_key_hasher
+from .spm_writer import SPMWriter
 
 SPM_VERSION = 1
 
@@ -64,78 +73,6 @@ def write_uint8(value1):
     return struct.pack("<B", value1)
 
 
-def write_half_float(float32):
-    if sys.version_info[0] == 3 and sys.version_info[1] > 5:
-        return struct.pack("<e", float32)
-    else:
-        import binascii
-        F16_EXPONENT_BITS = 0x1F
-        F16_EXPONENT_SHIFT = 10
-        F16_EXPONENT_BIAS = 15
-        F16_MANTISSA_BITS = 0x3ff
-        F16_MANTISSA_SHIFT = (23 - F16_EXPONENT_SHIFT)
-        F16_MAX_EXPONENT = (F16_EXPONENT_BITS << F16_EXPONENT_SHIFT)
-
-        a = struct.pack('>f', float32)
-        b = binascii.hexlify(a)
-
-        f32 = int(b, 16)
-        f16 = 0
-        sign = (f32 >> 16) & 0x8000
-        exponent = ((f32 >> 23) & 0xff) - 127
-        mantissa = f32 & 0x007fffff
-
-        if exponent == 128:
-            f16 = sign | F16_MAX_EXPONENT
-            if mantissa:
-                f16 |= (mantissa & F16_MANTISSA_BITS)
-        elif exponent > 15:
-            f16 = sign | F16_MAX_EXPONENT
-        elif exponent > -15:
-            exponent += F16_EXPONENT_BIAS
-            mantissa >>= F16_MANTISSA_SHIFT
-            f16 = sign | exponent << F16_EXPONENT_SHIFT | mantissa
-        else:
-            f16 = sign
-        return write_uint16(f16)
-
-
-def write_2101010_rev(vector3):
-    part = 0
-    ret = 0
-    v = min(1.0, max(-1.0, vector3[0]))
-    if v > 0.0:
-        part = (int)((v * 511.0) + 0.5)
-    else:
-        part = (int)((v * 512.0) - 0.5)
-    ret |= part & 1023
-
-    v = min(1.0, max(-1.0, vector3[1]))
-    if v > 0.0:
-        part = (int)((v * 511.0) + 0.5)
-    else:
-        part = (int)((v * 512.0) - 0.5)
-    ret |= (part & 1023) << 10
-
-    v = min(1.0, max(-1.0, vector3[2]))
-    if v > 0.0:
-        part = (int)((v * 511.0) + 0.5)
-    else:
-        part = (int)((v * 512.0) - 0.5)
-    ret |= (part & 1023) << 20
-
-    if len(vector3) == 4:
-        v = min(1.0, max(-1.0, vector3[3]))
-        if v > 0.0:
-            part = (int)((v * 1.0) + 0.5)
-        else:
-            part = (int)((v * 2.0) - 0.5)
-    else:
-        part = 0
-    ret |= (part & 3) << 30
-    return write_uint(ret)
-
-
 def write_len_string(value):
     encoded = str.encode(value)
     if len(encoded) > 255:
@@ -148,41 +85,80 @@ def write_len_string(value):
     return tmp_buf
 
 
-def write_matrix_as_locRotScale(mat):
+def write_fixed_string(value):
     """
+    Null terminated char[64] as used by the make_spm intermediates
+    :param value:
+    :return:
+    """
+    return struct.pack("<64s", str.encode(value)[0:63])
+
 
+def matrix_to_locRotScale(mat):
+    """
+    Location, rotation and scale of a matrix in the SPM coordinate system
     :param mat:
-    :return:
+    :return: tuple of 10 floats
     """
     loc, rot, scale = mat.decompose()
     rot.normalized()
     loc = loc.to_tuple()
     rot = (-rot.x, -rot.z, -rot.y, rot.w)
     scale = scale.to_tuple()
-    return struct.pack(
-        '<ffffffffff', loc[0], loc[2], loc[1], rot[0], rot[1], rot[2], rot[3], scale[0], scale[2], scale[1]
-    )
+    return loc[0], loc[2], loc[1], rot[0], rot[1], rot[2], rot[3], scale[0], scale[2], scale[1]
 
 
-def get_unique_frame(armature, is_keyframes_only):
+def write_matrix_as_locRotScale(mat):
+    """
+
+    :param mat:
+    :return:
+    """
+    return struct.pack('<ffffffffff', *matrix_to_locRotScale(mat))
+
+
+def get_keyframe_times(curve):
+    """
+    Frame of every keyframe of an fcurve, fetched in one call
+    :param curve:
+    :return: float64 array
+    """
+    co = np.empty(len(curve.keyframe_points) * 2, dtype=np.float64)
+    curve.keyframe_points.foreach_get("co", co)
+    return co[0::2]
+
+
+def merge_intervals(intervals):
+    """
+    Merge overlapping or touching half open [start, end) intervals
+    :param intervals:
+    :return: sorted list of disjoint intervals
     """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
 
+def get_unique_frame(armature, is_keyframes_only):
+    """
+    Sorted frames holding a keyframe of the armature, its NLA strips or the
+    targets of its bone constraints, frames are gathered in a set and the
+    frame ranges of fcurve modifiers are merged before being added
     :param armature:
     :param is_keyframes_only:
     :return:
     """
-    unique_frame = []
+    unique_frame = set()
     if armature.animation_data and armature.animation_data.action:
         ipo = armature.animation_data.action.fcurves
         for curve in ipo:
             if "pose" in curve.data_path:
-                for keyframe in curve.keyframe_points:
-                    if keyframe.co[0] < 0:
-                        continue
-                    global_key = int(keyframe.co[0])
-                    global_key = 1 if global_key == 0 else global_key
-                    if global_key not in unique_frame:
-                        unique_frame.append(global_key)
+                times = get_keyframe_times(curve)
+                unique_frame.update(times[times >= 0].astype(np.int64).tolist())
 
     for nla_track in armature.animation_data.nla_tracks:
         for nla_strip in nla_track.strips:
@@ -190,19 +166,12 @@ def get_unique_frame(armature, is_keyframes_only):
             if nla_strip.action:
                 for action_group in nla_strip.action.groups:
                     for curve in action_group.channels:
-                        for keyframe in curve.keyframe_points:
-                            if keyframe.co[0] < 0:
-                                continue
-
-                            global_key = int(nla_strip.frame_start + keyframe.co[0])
-                            if global_key > max_frame:
-                                global_key = int(nla_strip.frame_start)
-
-                            global_key = 1 if global_key == 0 else global_key
-                            # print('f: {} {} {}'.format(nla_strip.name, nla_strip.frame_start, keyframe.co[0]))
-                            if global_key not in unique_frame:
-                                unique_frame.append(global_key)
+                        times = get_keyframe_times(curve)
+                        global_keys = (nla_strip.frame_start + times[times >= 0]).astype(np.int64)
+                        global_keys[global_keys > max_frame] = int(nla_strip.frame_start)
+                        unique_frame.update(global_keys.tolist())
 
+    modifier_ranges = []
     for pose_bone in armature.pose.bones:
         for constraint in pose_bone.constraints:
             try:
@@ -211,53 +180,33 @@ def get_unique_frame(armature, is_keyframes_only):
                     for curve in ipo:
                         for modifier in curve.modifiers:
                             if modifier.frame_start > 0 and modifier.frame_end > 0:
-                                for f in range(int(modifier.frame_start), int(modifier.frame_end + 1)):
-                                    #print('{} {}'.format(f, modifier.type))
-                                    if f not in unique_frame:
-                                        unique_frame.append(f)
-                        # print('{}'.format(constraint.name))
-                        for keyframe in curve.keyframe_points:
-                            if keyframe.co[0] < 0:
-                                continue
-                            global_key = int(keyframe.co[0])
-                            global_key = 1 if global_key == 0 else global_key
-                            # print('f: {} {}'.format(global_key, constraint.target.name))
-                            if global_key not in unique_frame:
-                                # bpy.context.scene.frame_set(global_key)
-                                # bpy.context.scene.frame_current = global_key
-                                # armature.update_tag(refresh={'OBJECT', 'DATA'})
-                                # bpy.context.scene.update()
-                                # if constraint.influence == 0.0:
-                                # print('unused')
-                                # continue
-                                unique_frame.append(global_key)
+                                modifier_ranges.append((int(modifier.frame_start), int(modifier.frame_end + 1)))
+                        times = get_keyframe_times(curve)
+                        unique_frame.update(times[times >= 0].astype(np.int64).tolist())
             except AttributeError:
                 pass
 
+    # Frame 0 keys are exported at frame 1, modifier ranges start after 0
+    if 0 in unique_frame:
+        unique_frame.remove(0)
+        unique_frame.add(1)
+    for start, end in merge_intervals(modifier_ranges):
+        unique_frame.update(range(start, end))
+
     if not unique_frame:
         print(
             'No keyframes found for armature: {},'
             ' please remove the armature if it contains no keyframe.'.format(armature.name)
         )
         assert False
-    unique_frame.sort()
-    # for frame in unique_frame:
-    #    print('unique_frame:{} {}'.format(frame, armature.name))
+    unique_frame = sorted(unique_frame)
     if not is_keyframes_only:
         first = bpy.context.scene.frame_start
         last = unique_frame[-1]
-        unique_frame = []
-        for frame in range(first, last + 1):
-            unique_frame.append(frame)
-        # for frame in unique_frame:
-        #    print('unique_frame:{} {}'.format(frame, armature.name))
+        unique_frame = list(range(first, last + 1))
     return unique_frame
 
 
-def equals(float1, float2):
-    return (float1 + 0.0001 >= float2) and (float1 - 0.0001 <= float2)
-
-
 class ExportArm:
     m_accumulated_bone = 0
 
@@ -268,32 +217,41 @@ class ExportArm:
         self.m_bone_names = {}
         for pose_bone in arm.pose.bones:
             self.m_bone_names[pose_bone.name] = 99999999
-
-    def build_index(self, all_triangles):
+        self.m_pose_bone_index = {pose_bone.name: b_idx for b_idx, pose_bone in enumerate(arm.pose.bones)}
+        self.m_frames = []
+        self.m_pose_matrices = None
+        self.m_world_matrices = None
+        self.m_locRotScale = None
+        self.m_kept_rows = []
+
+    def build_index(self, triangles):
         """
-
-        :param all_triangles:
+        Give the bones influencing the armature's triangles an id in order of
+        first use and fill the joints and weights of their corners with the
+        4 strongest bone influences of each vertex
+        :param triangles:
         :return:
         """
-        for triangle in all_triangles:
-            if triangle.m_armature_name != self.m_arm.data.name:
-                continue
-            for i in range(0, 3):
-                found = 0
-                for joint_and_weight in triangle.m_all_joints_weights[i]:
-                    if found > 3:
-                        break
-                    if joint_and_weight[0] in self.m_bone_names:
-                        if self.m_bone_names[joint_and_weight[0]] == 99999999:
-                            self.m_bone_names[joint_and_weight[0]] = ExportArm.m_accumulated_bone
-                            triangle.m_all_joints[i][found] = ExportArm.m_accumulated_bone
-                            triangle.m_all_weights[i][found] = joint_and_weight[1]
-                            ExportArm.m_accumulated_bone += 1
-                        else:
-                            triangle.m_all_joints[i][found] = \
-                                self.m_bone_names[joint_and_weight[0]]
-                            triangle.m_all_weights[i][found] = joint_and_weight[1]
-                        found += 1
+        if self.m_arm.data.name not in triangles.m_armature_names:
+            return
+        arm_triangles = np.flatnonzero(triangles.m_armature == triangles.m_armature_names.index(self.m_arm.data.name))
+        vertex_names, vertex_weights = triangles.get_vertex_influences(self.m_bone_names)
+        corner_vertex = triangles.m_corner_vertex[arm_triangles]
+        corner_names = vertex_names[corner_vertex]
+
+        used = corner_names.ravel()
+        used = used[used >= 0]
+        names, first = np.unique(used, return_index=True)
+        names = names[np.argsort(first)]
+        # The extra last entry maps unused slots (-1) to -1
+        bone_ids = np.full(len(triangles.m_influence_names) + 1, -1, dtype=np.int64)
+        for name in names.tolist():
+            bone_ids[name] = ExportArm.m_accumulated_bone
+            self.m_bone_names[triangles.m_influence_names[name]] = ExportArm.m_accumulated_bone
+            ExportArm.m_accumulated_bone += 1
+
+        triangles.m_all_joints[arm_triangles] = bone_ids[corner_names]
+        triangles.m_all_weights[arm_triangles] = vertex_weights[corner_vertex]
 
     def build_local_id(self):
         for k, v in self.m_bone_names.items():
@@ -342,203 +300,675 @@ class ExportArm:
             else:
                 tmp_buf += write_int16(-1)
 
-        unique_frame = get_unique_frame(self.m_arm, export_settings.get("keyframes-only"))
-        tmp_buf += write_uint16(len(unique_frame))
-        for frame in unique_frame:
-            bpy.context.scene.frame_set(frame)
-            tmp_buf += write_uint16(frame - 1)
-            for bone_tu in self.m_bone_local_id:
-                pose_bone = self.m_arm.pose.bones[bone_tu[0]]
-                if pose_bone.parent:
-                    bone_mat = pose_bone.parent.matrix.inverted_safe() * pose_bone.matrix
-                else:
-                    if export_settings.get("local-space"):
-                        bone_mat = pose_bone.matrix.copy()
-                    else:
-                        bone_mat = self.m_arm.matrix_world * pose_bone.matrix.copy()
-                tmp_buf += write_matrix_as_locRotScale(bone_mat)
+        bone_order = [self.m_pose_bone_index[bone_tu[0]] for bone_tu in self.m_bone_local_id]
+        tmp_buf += write_uint16(len(self.m_kept_rows))
+        for row in self.m_kept_rows:
+            tmp_buf += write_uint16(self.m_frames[row] - 1)
+            tmp_buf += self.m_locRotScale[row, bone_order].astype("<f4").tobytes()
 
         return tmp_buf
 
+    def prepare_sampling(self, export_settings):
+        """
+        Find the frames to export and allocate the arrays capture_pose fills
+        :param export_settings:
+        :return:
+        """
+        self.m_frames = get_unique_frame(self.m_arm, export_settings.get("keyframes-only"))
+        self.m_pose_matrices = np.empty((len(self.m_frames), len(self.m_arm.pose.bones), 4, 4), dtype=np.float64)
+        self.m_world_matrices = np.empty((len(self.m_frames), 4, 4), dtype=np.float64)
+
+    def capture_pose(self, row):
+        """
+        Copy the pose matrices of the current scene frame into row
+        :param row: index of the frame in m_frames
+        :return:
+        """
+        for b_idx, pose_bone in enumerate(self.m_arm.pose.bones):
+            self.m_pose_matrices[row, b_idx] = pose_bone.matrix
+        self.m_world_matrices[row] = self.m_arm.matrix_world
 
-class Vertex:
-    m_cmp_joint = False
-
-    def __init__(self):
-        self.m_position = []
-        self.m_normal = []
-        self.m_color = []
-        self.m_all_uvs = []
-        self.m_tangent = []
-        self.m_joints = []
-        self.m_weights = []
-        self.m_hash = 0
-
-    def set_hash_string(self):
-        # Round down floating point value
-        self.m_hash = hash(str(round(self.m_position[0], 3)) +
-                           str(round(self.m_position[1], 3)) + str(round(self.m_position[2], 3)) +
-                           str(round(self.m_normal[0], 3)) + str(round(self.m_normal[1], 3)) +
-                           str(round(self.m_normal[2], 3)) + str(round(self.m_all_uvs[0], 3)) +
-                           str(round(self.m_all_uvs[3], 3)) + str(self.m_joints[0]) +
-                           str(self.m_joints[1]) + str(round(self.m_weights[0], 3)) +
-                           str(self.m_tangent[3])) if Vertex.m_cmp_joint\
-            else hash(str(round(self.m_position[0], 3)) +
-                      str(round(self.m_position[1], 3)) + str(round(self.m_position[2], 3)) +
-                      str(round(self.m_normal[0], 3)) + str(round(self.m_normal[1], 3)) +
-                      str(round(self.m_normal[2], 3)) + str(round(self.m_all_uvs[0], 3)) +
-                      str(round(self.m_all_uvs[3], 3)) + str(self.m_tangent[3]))
-
-    def __hash__(self):
-        return self.m_hash
-
-    def __eq__(self, other):
-        return equals(self.m_position[0], other.m_position[0]) and\
-            equals(self.m_position[1], other.m_position[1]) and\
-            equals(self.m_position[2], other.m_position[2]) and\
-            equals(self.m_normal[0], other.m_normal[0]) and\
-            equals(self.m_normal[1], other.m_normal[1]) and\
-            equals(self.m_normal[2], other.m_normal[2]) and\
-            (self.m_color[0] == other.m_color[0]) and\
-            (self.m_color[1] == other.m_color[1]) and\
-            (self.m_color[2] == other.m_color[2]) and\
-            equals(self.m_all_uvs[0], other.m_all_uvs[0]) and\
-            equals(self.m_all_uvs[1], other.m_all_uvs[1]) and\
-            equals(self.m_all_uvs[2], other.m_all_uvs[2]) and\
-            equals(self.m_all_uvs[3], other.m_all_uvs[3]) and\
-            (self.m_joints[0] == other.m_joints[0]) and\
-            (self.m_joints[1] == other.m_joints[1]) and\
-            (self.m_joints[2] == other.m_joints[2]) and\
-            (self.m_joints[3] == other.m_joints[3]) and\
-            equals(self.m_weights[0], other.m_weights[0]) and\
-            equals(self.m_weights[1], other.m_weights[1]) and\
-            equals(self.m_weights[2], other.m_weights[2]) and\
-            equals(self.m_weights[3], other.m_weights[3]) and\
-            self.m_tangent[3] == other.m_tangent[3] if Vertex.m_cmp_joint\
-            else equals(self.m_position[0], other.m_position[0]) and\
-            equals(self.m_position[1], other.m_position[1]) and\
-            equals(self.m_position[2], other.m_position[2]) and\
-            equals(self.m_normal[0], other.m_normal[0]) and\
-            equals(self.m_normal[1], other.m_normal[1]) and\
-            equals(self.m_normal[2], other.m_normal[2]) and\
-            (self.m_color[0] == other.m_color[0]) and\
-            (self.m_color[1] == other.m_color[1]) and\
-            (self.m_color[2] == other.m_color[2]) and\
-            equals(self.m_all_uvs[0], other.m_all_uvs[0]) and\
-            equals(self.m_all_uvs[1], other.m_all_uvs[1]) and\
-            equals(self.m_all_uvs[2], other.m_all_uvs[2]) and\
-            equals(self.m_all_uvs[3], other.m_all_uvs[3]) and\
-            self.m_tangent[3] == other.m_tangent[3]
-
-    def write_vertex(self, uv_1, uv_2, vcolor, write_joints, need_export_tangent, export_normal):
+    def get_bone_matrices(self, row, bone_names, export_settings):
+        """
+        Captured matrices of bone_names, relative to the parent bone or in
+        object / world space for root bones
+        :param row: index of the frame in m_frames
+        :param bone_names:
+        :param export_settings:
+        :return: list of matrices
         """
+        pose_bones = self.m_arm.pose.bones
+        pose_matrices = self.m_pose_matrices[row]
+        bone_mats = []
+        for bone_name in bone_names:
+            pose_bone = pose_bones[bone_name]
+            matrix = mathutils.Matrix(pose_matrices[self.m_pose_bone_index[bone_name]].tolist())
+            if pose_bone.parent:
+                parent_matrix = mathutils.Matrix(pose_matrices[self.m_pose_bone_index[pose_bone.parent.name]].tolist())
+                bone_mat = parent_matrix.inverted_safe() * matrix
+            else:
+                if export_settings.get("local-space"):
+                    bone_mat = matrix
+                else:
+                    bone_mat = mathutils.Matrix(self.m_world_matrices[row].tolist()) * matrix
+            bone_mats.append(bone_mat)
+        return bone_mats
 
-        :param uv_1:
-        :param uv_2:
-        :param vcolor:
-        :param write_joints:
-        :param need_export_tangent:
-        :param export_normal:
+    def build_keyframes(self, export_settings):
+        """
+        Convert the captured poses of all bones to location, rotation and
+        scale, then drop the frames interpolation reproduces within the
+        keyframe tolerance
+        :param export_settings:
         :return:
         """
-        tmp_buf = bytearray()
-        for i in range(0, 3):
-            tmp_buf += write_float(self.m_position[i])
+        bone_names = [pose_bone.name for pose_bone in self.m_arm.pose.bones]
+        self.m_locRotScale = np.array(
+            [
+                [
+                    matrix_to_locRotScale(bone_mat)
+                    for bone_mat in self.get_bone_matrices(row, bone_names, export_settings)
+                ] for row in range(0, len(self.m_frames))
+            ],
+            dtype=np.float64
+        ).reshape(len(self.m_frames), len(bone_names), 10)
+
+        tolerance = export_settings.get("keyframe-tolerance")
+        if not tolerance:
+            self.m_kept_rows = list(range(0, len(self.m_frames)))
+            return
+        self.m_kept_rows = spm_anim.decimate_keyframes(self.m_frames, self.m_locRotScale, tolerance)
+        print(
+            "{}: kept {} of {} frames, {:.2f}x smaller".format(
+                self.m_arm.name, len(self.m_kept_rows), len(self.m_frames),
+                len(self.m_frames) / len(self.m_kept_rows)
+            )
+        )
 
-        if export_normal:
-            tmp_buf += write_2101010_rev(self.m_normal)
+    def write_animated_data(self, export_settings, static_mesh_frame):
+        """
+        Armature intermediate read by make_spm (<name>N.animated_data)
+        :param export_settings:
+        :param static_mesh_frame:
+        :return:
+        """
+        tmp_buf = bytearray()
+        tmp_buf += write_fixed_string(self.m_arm.data.name)
+        tmp_buf += write_uint(static_mesh_frame - 1)
+        tmp_buf += write_uint(len(self.m_arm.data.bones))
+        for bone in self.m_arm.data.bones:
+            tmp_buf += write_fixed_string(bone.name)
+            tmp_buf += write_matrix_as_locRotScale(bone.matrix_local.inverted_safe())
 
-        if vcolor:
-            if self.m_color[0] == 255 and self.m_color[1] == 255 and\
-                    self.m_color[2] == 255:
-                tmp_buf += write_uint8(128)
-            else:
-                tmp_buf += write_uint8(255)
-                tmp_buf += write_uint8(self.m_color[0])
-                tmp_buf += write_uint8(self.m_color[1])
-                tmp_buf += write_uint8(self.m_color[2])
-
-        if uv_1:
-            tmp_buf += write_half_float(self.m_all_uvs[0])
-            tmp_buf += write_half_float(self.m_all_uvs[1])
-            if uv_2:
-                tmp_buf += write_half_float(self.m_all_uvs[2])
-                tmp_buf += write_half_float(self.m_all_uvs[3])
-            if need_export_tangent:
-                tmp_buf += write_2101010_rev(self.m_tangent)
-
-        if write_joints:
-            tmp_buf += write_int16(self.m_joints[0])
-            tmp_buf += write_int16(self.m_joints[1])
-            tmp_buf += write_int16(self.m_joints[2])
-            tmp_buf += write_int16(self.m_joints[3])
-            tmp_buf += write_half_float(self.m_weights[0])
-            tmp_buf += write_half_float(self.m_weights[1])
-            tmp_buf += write_half_float(self.m_weights[2])
-            tmp_buf += write_half_float(self.m_weights[3])
+        bone_names = [pose_bone.name for pose_bone in self.m_arm.pose.bones]
+        parent_names = [pose_bone.parent.name if pose_bone.parent else "" for pose_bone in self.m_arm.pose.bones]
+        tmp_buf += write_uint(len(self.m_kept_rows))
+        for row in self.m_kept_rows:
+            tmp_buf += write_uint(self.m_frames[row] - 1)
+            tmp_buf += write_uint(len(bone_names))
+            for b_idx, (bone_name, parent_name) in enumerate(zip(bone_names, parent_names)):
+                tmp_buf += write_fixed_string(bone_name)
+                tmp_buf += write_fixed_string(parent_name)
+                tmp_buf += self.m_locRotScale[row, b_idx].astype("<f4").tobytes()
 
         return tmp_buf
 
 
-class Triangle:
-
-    def __init__(self):
-        self.m_position = []
-        self.m_normal = []
-        self.m_color = []
-        self.m_all_uvs = []
-        self.m_tangent = []
-        self.m_all_joints = [[-1, -1, -1, -1], [-1, -1, -1, -1], [-1, -1, -1, -1]]
-        self.m_all_weights = [[0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0], [0.0, 0.0, 0.0, 0.0]]
-        self.m_all_joints_weights = []
-        self.m_texture_one = ""
-        self.m_texture_two = ""
-        self.m_texture_cmp = ""
-        self.m_armature_name = ""
-        self.m_hash = 0
-
-    def get3_vertices(self):
-        vertices = []
-        for i in range(0, 3):
-            vertices.append(Vertex())
-            vertices[i].m_position = self.m_position[i]
-            vertices[i].m_normal = self.m_normal[i]
-            vertices[i].m_color = self.m_color[i]
-            vertices[i].m_all_uvs = self.m_all_uvs[i]
-            vertices[i].m_tangent = self.m_tangent[i]
-            vertices[i].m_joints = self.m_all_joints[i]
-            vertices[i].m_weights = self.m_all_weights[i]
-            vertices[i].set_hash_string()
-
-        return vertices
-
-    def __hash__(self):
-        return self.m_hash
-
-    def __eq__(self, other):
-        return self.m_position[0][0] == other.m_position[0][0] and\
-            self.m_position[0][1] == other.m_position[0][1] and\
-            self.m_position[0][2] == other.m_position[0][2] and\
-            self.m_position[1][0] == other.m_position[1][0] and\
-            self.m_position[1][1] == other.m_position[1][1] and\
-            self.m_position[1][2] == other.m_position[1][2] and\
-            self.m_position[2][0] == other.m_position[2][0] and\
-            self.m_position[2][1] == other.m_position[2][1] and\
-            self.m_position[2][2] == other.m_position[2][2]
-
-    def set_hash_string(self):
-        self.m_hash = hash(
-            str(round(self.m_position[0][0], 7)) + str(round(self.m_position[0][1], 7)) + str(
-                round(self.m_position[0][2], 7)
-            ) + str(round(self.m_position[1][0], 7)) + str(round(self.m_position[1][1], 7)) +
-            str(round(self.m_position[1][2], 7)) + str(round(self.m_position[2][0], 7)) +
-            str(round(self.m_position[2][1], 7)) + str(round(self.m_position[2][2], 7))
+def sample_armatures(export_arms, export_settings):
+    """
+    Capture the poses of all armatures in one sweep over the union of their
+    frames, so the scene is evaluated once per frame instead of once per
+    frame and armature, then build their keyframes
+    :param export_arms: list of ExportArm
+    :param export_settings:
+    :return:
+    """
+    frame_rows = []
+    for export_arm in export_arms:
+        export_arm.prepare_sampling(export_settings)
+        frame_rows.append({frame: row for row, frame in enumerate(export_arm.m_frames)})
+
+    for frame in sorted(set().union(*frame_rows)):
+        bpy.context.scene.frame_set(frame)
+        for export_arm, rows in zip(export_arms, frame_rows):
+            row = rows.get(frame)
+            if row is not None:
+                export_arm.capture_pose(row)
+
+    for export_arm in export_arms:
+        export_arm.build_keyframes(export_settings)
+
+
+class TriangleArrays:
+    """
+    Column store of exported triangles, every per-corner attribute is an array
+    of shape (triangle count, 3, n) instead of a python object per triangle.
+    Textures and armatures are integer ids into small shared tables
+    """
+
+    __slots__ = (
+        "m_position", "m_normal", "m_color", "m_all_uvs", "m_tangent", "m_all_joints", "m_all_weights",
+        "m_corner_vertex", "m_vertex_count", "m_influence_vertex", "m_influence_name", "m_influence_weight",
+        "m_influence_names", "m_material", "m_materials", "m_armature", "m_armature_names"
+    )
+
+    def __init__(self, count=0):
+        self.m_position = np.zeros((count, 3, 3), dtype=np.float32)
+        self.m_normal = np.zeros((count, 3, 3), dtype=np.float64)
+        self.m_color = np.full((count, 3, 3), 255, dtype=np.uint8)
+        self.m_all_uvs = np.zeros((count, 3, 4), dtype=np.float64)
+        self.m_tangent = np.zeros((count, 3, 4), dtype=np.float64)
+        self.m_tangent[:, :, 3] = 1.0
+        self.m_all_joints = np.full((count, 3, 4), -1, dtype=np.int16)
+        self.m_all_weights = np.zeros((count, 3, 4), dtype=np.float64)
+        # Vertex of each corner in the influence table, -1 without joints
+        self.m_corner_vertex = np.full((count, 3), -1, dtype=np.int64)
+        # Vertex group influences sorted by vertex then decreasing weight,
+        # shared between copies made by take
+        self.m_vertex_count = 0
+        self.m_influence_vertex = np.zeros(0, dtype=np.int64)
+        self.m_influence_name = np.zeros(0, dtype=np.int64)
+        self.m_influence_weight = np.zeros(0, dtype=np.float64)
+        self.m_influence_names = []
+        # Material of each triangle, index of its (texture one, texture two)
+        self.m_material = np.zeros(count, dtype=np.int64)
+        self.m_materials = [("", "")]
+        self.m_armature = np.zeros(count, dtype=np.int64)
+        self.m_armature_names = ["NULL"]
+
+    def __len__(self):
+        return len(self.m_position)
+
+    def take(self, order):
+        """
+        Return a copy with the triangles reordered by the index list order
+        :param order:
+        :return:
+        """
+        triangles = TriangleArrays()
+        for name in (
+            "m_position", "m_normal", "m_color", "m_all_uvs", "m_tangent", "m_all_joints", "m_all_weights",
+            "m_corner_vertex", "m_material", "m_armature"
+        ):
+            setattr(triangles, name, getattr(self, name)[order])
+        for name in (
+            "m_vertex_count", "m_influence_vertex", "m_influence_name", "m_influence_weight", "m_influence_names",
+            "m_materials", "m_armature_names"
+        ):
+            setattr(triangles, name, getattr(self, name))
+        return triangles
+
+    def sort_by_material(self, spatial=False):
+        """
+        Return a copy sorted by material, used materials are renumbered in the
+        order of their texture names so the ids match the written material
+        table
+        :param spatial: order the triangles of each material along a Morton
+                        curve through their centroids, so the mesh buffers
+                        split from it are spatially compact
+        :return:
+        """
+        used = np.unique(self.m_material)
+        keys = [(''.join(self.m_materials[m_idx]), self.m_materials[m_idx]) for m_idx in used.tolist()]
+        used = used[sorted(range(0, len(used)), key=keys.__getitem__)]
+        rank = np.zeros(len(self.m_materials), dtype=np.int64)
+        rank[used] = np.arange(len(used))
+
+        if spatial:
+            morton = spm_mesh.morton_code(self.m_position.mean(axis=1))
+            order = np.lexsort((morton, rank[self.m_material]))
+        else:
+            order = np.argsort(rank[self.m_material], kind='stable')
+        triangles = self.take(order)
+        triangles.m_material = rank[triangles.m_material]
+        triangles.m_materials = [self.m_materials[m_idx] for m_idx in used.tolist()]
+        return triangles
+
+    @staticmethod
+    def concatenate(all_triangles):
+        triangles = TriangleArrays()
+        for name in ("m_position", "m_normal", "m_color", "m_all_uvs", "m_tangent", "m_all_joints", "m_all_weights"):
+            setattr(triangles, name, np.concatenate([getattr(t, name) for t in all_triangles]))
+        for name, table in (("m_material", "m_materials"), ("m_armature", "m_armature_names")):
+            ids = {}
+            remapped = []
+            for t in all_triangles:
+                remap = np.array([ids.setdefault(each, len(ids)) for each in getattr(t, table)], dtype=np.int64)
+                remapped.append(remap[getattr(t, name)])
+            setattr(triangles, name, np.concatenate(remapped))
+            setattr(triangles, table, sorted(ids, key=ids.__getitem__))
+
+        # Merge the influence tables, vertex ids are offset and group names
+        # are mapped to one name table
+        name_index = {}
+        corner_vertex = []
+        influence_vertex = []
+        influence_name = []
+        for t in all_triangles:
+            corner_vertex.append(np.where(t.m_corner_vertex >= 0, t.m_corner_vertex + triangles.m_vertex_count, -1))
+            influence_vertex.append(t.m_influence_vertex + triangles.m_vertex_count)
+            names = np.array(
+                [name_index.setdefault(name, len(name_index)) for name in t.m_influence_names], dtype=np.int64
+            )
+            influence_name.append(names[t.m_influence_name])
+            triangles.m_vertex_count += t.m_vertex_count
+        triangles.m_corner_vertex = np.concatenate(corner_vertex)
+        triangles.m_influence_vertex = np.concatenate(influence_vertex)
+        triangles.m_influence_name = np.concatenate(influence_name)
+        triangles.m_influence_weight = np.concatenate([t.m_influence_weight for t in all_triangles])
+        triangles.m_influence_names = sorted(name_index, key=name_index.__getitem__)
+        return triangles
+
+    def get_vertex_influences(self, names, max_influences=4):
+        """
+        Strongest influences of each vertex among the vertex groups in names
+        :param names: group names to consider
+        :param max_influences:
+        :return: (vertex count, max_influences) name index, -1 when unused,
+                 and the matching weights
+        """
+        in_names = np.array([name in names for name in self.m_influence_names], dtype=bool)
+        return spm_mesh.select_influences(
+            self.m_influence_vertex, self.m_influence_name, self.m_influence_weight, self.m_vertex_count, in_names,
+            max_influences
         )
 
 
+def get_texture_names(uv_texture):
+    """
+    Basename of the image assigned to each face of a uv texture layer
+    :param uv_texture:
+    :return:
+    """
+    names = {}
+    texture_names = []
+    for poly_texture in uv_texture.data:
+        image = poly_texture.image
+        if image is None:
+            texture_names.append("")
+            continue
+        if image.name not in names:
+            names[image.name] = os.path.basename(image.filepath)
+        texture_names.append(names[image.name])
+    return texture_names
+
+
+def get_face_materials(mesh, uv_one, uv_two):
+    """
+    Number the (texture one, texture two) pairs used by the faces of a mesh
+    :param mesh:
+    :param uv_one:
+    :param uv_two:
+    :return: list of pairs, material id of each face
+    """
+    face_count = len(mesh.polygons)
+    texture_one = get_texture_names(mesh.uv_textures[0]) if uv_one else [""] * face_count
+    texture_two = get_texture_names(mesh.uv_textures[1]) if uv_two else [""] * face_count
+    material_ids = {}
+    face_material = np.array(
+        [material_ids.setdefault(pair, len(material_ids)) for pair in zip(texture_one, texture_two)], dtype=np.int64
+    )
+    return sorted(material_ids, key=material_ids.__getitem__), face_material
+
+
+def hash_export_object(hasher, obj, mesh, mesh_matrix):
+    """
+    Feed everything the export reads from an evaluated mesh into hasher
+    :param hasher: from spm_cache.new_key_hasher
+    :param obj:
+    :param mesh: evaluated mesh, before any transformation
+    :param mesh_matrix: world matrix, None for local space exports
+    :return:
+    """
+    modifiers = [(modifier.type, modifier.show_viewport, modifier.show_render) for modifier in obj.modifiers]
+    hasher.update(str.encode(repr(modifiers)))
+    if mesh_matrix is not None:
+        hasher.update(np.array(mesh_matrix, dtype=np.float64).tobytes())
+
+    arrays = (
+        (mesh.vertices, "co", np.float32, 3),
+        (mesh.vertices, "normal", np.float32, 3),
+        (mesh.loops, "vertex_index", np.int32, 1),
+        (mesh.polygons, "loop_start", np.int32, 1),
+        (mesh.polygons, "loop_total", np.int32, 1),
+    )
+    for collection, attribute, dtype, width in arrays:
+        values = np.empty(len(collection) * width, dtype=dtype)
+        collection.foreach_get(attribute, values)
+        hasher.update(values.tobytes())
+
+    active_uv = mesh.uv_textures.active.name if mesh.uv_textures.active else ""
+    hasher.update(str.encode(repr((active_uv, len(mesh.uv_textures)))))
+    for uv_texture, uv_layer in zip(mesh.uv_textures, mesh.uv_layers):
+        hasher.update(str.encode("\n".join(get_texture_names(uv_texture))))
+        uvs = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+        uv_layer.data.foreach_get("uv", uvs)
+        hasher.update(uvs.tobytes())
+
+    hasher.update(str.encode(repr(len(mesh.vertex_colors))))
+    if len(mesh.vertex_colors) > 0:
+        colors = np.empty(len(mesh.loops) * 3, dtype=np.float32)
+        mesh.vertex_colors[0].data.foreach_get("color", colors)
+        hasher.update(colors.tobytes())
+
+
+def extract_triangles(obj, mesh, uv_one, uv_two, need_export_tangent, read_joints, arm):
+    """
+    Read a triangulated mesh into a TriangleArrays, all per-vertex and per-loop
+    data is fetched in bulk with foreach_get
+    :param obj:
+    :param mesh:
+    :param uv_one:
+    :param uv_two:
+    :param need_export_tangent:
+    :param read_joints:
+    :param arm:
+    :return:
+    """
+    polygon_count = len(mesh.polygons)
+    loop_total = np.empty(polygon_count, dtype=np.int32)
+    mesh.polygons.foreach_get("loop_total", loop_total)
+    # Because of triangulated
+    assert (loop_total == 3).all()
+    loop_start = np.empty(polygon_count, dtype=np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_start)
+    loops = loop_start[:, None] + np.arange(3, dtype=np.int32)
+
+    loop_vertex = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vertex)
+    vertex_index = loop_vertex[loops]
+
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    normal = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("normal", normal)
+    normal = normal.reshape(-1, 3).astype(np.float64)
+    length = np.linalg.norm(normal, axis=1)
+    normal[length > 0.0] /= length[length > 0.0, None]
+
+    triangles = TriangleArrays(polygon_count)
+    triangles.m_position = co.reshape(-1, 3)[vertex_index]
+    triangles.m_normal = normal[vertex_index]
+    triangles.m_armature_names = [arm.data.name if arm is not None else "NULL"]
+    triangles.m_materials, triangles.m_material = get_face_materials(mesh, uv_one, uv_two)
+
+    for layer, enabled in ((0, uv_one), (1, uv_two)):
+        if not enabled:
+            continue
+        uv = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+        mesh.uv_layers[layer].data.foreach_get("uv", uv)
+        uv = uv.reshape(-1, 2)[loops].astype(np.float64)
+        triangles.m_all_uvs[:, :, layer * 2] = uv[:, :, 0]
+        triangles.m_all_uvs[:, :, layer * 2 + 1] = 1.0 - uv[:, :, 1]
+
+    if len(mesh.vertex_colors) > 0:
+        vcolor = np.empty(len(mesh.loops) * 3, dtype=np.float32)
+        mesh.vertex_colors[0].data.foreach_get("color", vcolor)
+        vcolor = vcolor.reshape(-1, 3)[loops].astype(np.float64) * 255
+        triangles.m_color = np.minimum(vcolor.astype(np.int64), 255).astype(np.uint8)
+
+    if read_joints:
+        # Vertex group elements have no foreach_get, gather them in flat lists
+        influence_vertex = []
+        influence_group = []
+        influence_weight = []
+        for vertex in mesh.vertices:
+            for group in vertex.groups:
+                influence_vertex.append(vertex.index)
+                influence_group.append(group.group)
+                influence_weight.append(group.weight)
+        influence_vertex = np.array(influence_vertex, dtype=np.int64)
+        influence_weight = np.array(influence_weight, dtype=np.float64)
+        # By vertex, then by decreasing weight keeping the group order on ties
+        order = np.lexsort((np.arange(len(influence_vertex)), -influence_weight, influence_vertex))
+        triangles.m_vertex_count = len(mesh.vertices)
+        triangles.m_corner_vertex = vertex_index.astype(np.int64)
+        triangles.m_influence_vertex = influence_vertex[order]
+        triangles.m_influence_name = np.array(influence_group, dtype=np.int64)[order]
+        triangles.m_influence_weight = influence_weight[order]
+        triangles.m_influence_names = [group.name for group in obj.vertex_groups]
+
+    if uv_one and need_export_tangent:
+        mesh.calc_tangents()
+        tangent = np.empty(len(mesh.loops) * 3, dtype=np.float32)
+        mesh.loops.foreach_get("tangent", tangent)
+        bitangent_sign = np.empty(len(mesh.loops), dtype=np.float32)
+        mesh.loops.foreach_get("bitangent_sign", bitangent_sign)
+        mesh.free_tangents()
+        tangent = tangent.reshape(-1, 3).astype(np.float64)
+        length = np.linalg.norm(tangent, axis=1)
+        tangent[length > 0.0] /= length[length > 0.0, None]
+        triangles.m_tangent[:, :, 0:3] = tangent[loops]
+        triangles.m_tangent[:, :, 3] = bitangent_sign[loops]
+
+    return triangles
+
+
+# ==== make_spm backend ====
+
+# Per corner record of <name>.mesh_data, see BlenderExportData in make_spm.cpp
+MESH_DATA_DTYPE = np.dtype(
+    [("data_float", "<f4", (13, )), ("uv_one_name", "S64"), ("uv_two_name", "S64"), ("arm_name", "S64")]
+)
+MESH_DATA_CHUNK = 65536
+MAKE_SPM_ERRORS = (
+    "Required 6 arguments.", "Mesh data not found.", "Joint data not found.", "More than 65535 textures are used.",
+    "More than 65535 sectors."
+)
+
+
+def find_make_spm(export_settings):
+    """
+    Locate the make_spm binary: explicit setting, then PATH, then next to this addon
+    :param export_settings:
+    :return: path or None
+    """
+    binary = export_settings.get("native-spm-binary")
+    if binary:
+        binary = bpy.path.abspath(binary)
+        return binary if os.path.isfile(binary) else None
+    binary = shutil.which("make_spm")
+    if binary:
+        return binary
+    for name in ("make_spm", "make_spm.exe"):
+        binary = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+        if os.path.isfile(binary) and os.access(binary, os.X_OK):
+            return binary
+    return None
+
+
+def to_fixed_strings(names):
+    """
+    Encode names for a S64 field, truncated so they stay null terminated
+    :param names:
+    :return:
+    """
+    return np.array([str.encode(name)[0:63] for name in names], dtype="S64")
+
+
+def write_native_mesh_data(path, triangles):
+    """
+    Stream all corners into <path>.mesh_data in chunks
+    :param path:
+    :param triangles:
+    :return:
+    """
+    arm_names = to_fixed_strings(triangles.m_armature_names)[triangles.m_armature]
+    uv_one_names = to_fixed_strings([textures[0] for textures in triangles.m_materials])[triangles.m_material]
+    uv_two_names = to_fixed_strings([textures[1] for textures in triangles.m_materials])[triangles.m_material]
+    with open(path + ".mesh_data", "wb") as mesh_data:
+        for start in range(0, len(triangles), MESH_DATA_CHUNK):
+            end = min(start + MESH_DATA_CHUNK, len(triangles))
+            records = np.empty((end - start, 3), dtype=MESH_DATA_DTYPE)
+            data_float = records["data_float"]
+            data_float[:, :, 0:3] = triangles.m_position[start:end]
+            data_float[:, :, 3:6] = triangles.m_normal[start:end]
+            data_float[:, :, 6:10] = triangles.m_all_uvs[start:end]
+            data_float[:, :, 10:13] = triangles.m_color[start:end] / 255.0
+            records["uv_one_name"] = uv_one_names[start:end, None]
+            records["uv_two_name"] = uv_two_names[start:end, None]
+            records["arm_name"] = arm_names[start:end, None]
+            mesh_data.write(records.tobytes())
+
+
+def write_native_joint_data(path, triangles):
+    """
+    Stream the vertex group weights of all corners into <path>.joint_data,
+    each vertex is only encoded once
+    :param path:
+    :param triangles:
+    :return:
+    """
+    starts = np.searchsorted(triangles.m_influence_vertex, np.arange(triangles.m_vertex_count + 1)).tolist()
+    names = [write_fixed_string(name) for name in triangles.m_influence_names]
+    influence_name = triangles.m_influence_name.tolist()
+    influence_weight = triangles.m_influence_weight.tolist()
+    encoded = {-1: write_int(0)}
+    with open(path + ".joint_data", "wb") as joint_data:
+        for vertex in triangles.m_corner_vertex.ravel().tolist():
+            data = encoded.get(vertex)
+            if data is None:
+                data = bytearray(write_int(starts[vertex + 1] - starts[vertex]))
+                for i in range(starts[vertex], starts[vertex + 1]):
+                    data += names[influence_name[i]]
+                    data += write_float(influence_weight[i])
+                encoded[vertex] = data
+            joint_data.write(data)
+
+
+def remove_native_data(path, arm_count):
+    """
+    make_spm removes its input itself unless it bails out early
+    :param path:
+    :param arm_count:
+    :return:
+    """
+    leftovers = [path + ".mesh_data", path + ".joint_data"]
+    leftovers += ["{}{}.animated_data".format(path, i) for i in range(0, arm_count)]
+    for leftover in leftovers:
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def export_native(binary, filename, triangles, arm_dict, export_settings, static_mesh_frame, flags):
+    """
+    Hand the extracted triangles to make_spm, which does the welding, skinning
+    and space partitioning itself. The armatures must be sampled already
+    :param binary:
+    :param filename:
+    :param triangles:
+    :param arm_dict:
+    :param export_settings:
+    :param static_mesh_frame:
+    :param flags: (do_sp, export_normal, export_vcolor)
+    :return: True if filename was written
+    """
+    do_sp, export_normal, export_vcolor = flags
+    # Same directory as the output, make_spm looks for materials.xml there
+    path = "%s.%d.tmp" % (filename, os.getpid())
+    arm_names = sorted(arm_dict.keys())
+    try:
+        write_native_mesh_data(path, triangles)
+        if arm_names:
+            write_native_joint_data(path, triangles)
+            for arm_idx, arm_name in enumerate(arm_names):
+                with open("{}{}.animated_data".format(path, arm_idx), "wb") as animated_data:
+                    animated_data.write(arm_dict[arm_name].write_animated_data(export_settings, static_mesh_frame))
+
+        args = [
+            binary, path, "do-sp" if do_sp else "no-sp",
+            str(len(arm_names)), "en" if export_normal else "nen", "ev" if export_vcolor else "nev", "net"
+        ]
+        result = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        output = result.stdout.strip()
+        if output:
+            print(output)
+        failed = result.returncode != 0 or any(line.strip() in MAKE_SPM_ERRORS for line in output.splitlines())
+        if failed or not os.path.isfile(path) or os.path.getsize(path) == 0:
+            print("make_spm failed, using the python exporter")
+            return False
+        os.replace(path, filename)
+        return True
+    except OSError as e:
+        print("make_spm failed ({}), using the python exporter".format(e))
+        return False
+    finally:
+        remove_native_data(path, len(arm_names))
+        if os.path.exists(path):
+            os.remove(path)
+
+
 # ==== Write SPM File ====
 
 
+def build_material_jobs(
+    triangles, export_vcolor, write_joints, need_export_tangent, export_normal, optimize=False, report_bounds=False
+):
+    """
+    Split material sorted triangles into one spm_mesh.encode_material job per
+    material
+    :param triangles: TriangleArrays from sort_by_material
+    :param export_vcolor:
+    :param write_joints:
+    :param need_export_tangent:
+    :param export_normal:
+    :param optimize: cull degenerate triangles and reorder for the vertex cache
+    :param report_bounds: print the bounding box of each mesh buffer
+    :return: list of jobs
+    """
+    all_positions = triangles.m_position.reshape(-1, 3)
+    all_normals = triangles.m_normal.reshape(-1, 3)
+    all_colors = triangles.m_color.reshape(-1, 3)
+    all_uvs = triangles.m_all_uvs.reshape(-1, 4)
+    all_tangents = triangles.m_tangent.reshape(-1, 4)
+    all_joints = triangles.m_all_joints.reshape(-1, 4)
+    all_weights = triangles.m_all_weights.reshape(-1, 4)
+
+    # Triangles are sorted by material, each run is split into mesh buffers
+    # of at most 65535 vertices
+    material_starts = [0] + (np.flatnonzero(np.diff(triangles.m_material)) + 1).tolist()
+    material_ends = material_starts[1:] + [len(triangles)]
+    jobs = []
+    for material_start, material_end in zip(material_starts, material_ends):
+        corners = slice(material_start * 3, material_end * 3)
+        material_id = int(triangles.m_material[material_start])
+        texture_one, texture_two = triangles.m_materials[material_id]
+        jobs.append(
+            {
+                "material_id": material_id,
+                "position": all_positions[corners],
+                "normal": all_normals[corners],
+                "color": all_colors[corners],
+                "all_uvs": all_uvs[corners],
+                "tangent": all_tangents[corners],
+                "joints": all_joints[corners],
+                "weights": all_weights[corners],
+                "uv_one": texture_one != "",
+                "uv_two": texture_two != "",
+                "vcolor": export_vcolor,
+                "write_joints": write_joints,
+                "export_tangent": need_export_tangent,
+                "export_normal": export_normal,
+                "optimize": optimize,
+                "report_bounds": report_bounds
+            }
+        )
+    return jobs
+
+
+def encode_material_jobs(jobs, processes=1):
+    """
+    Run spm_mesh.encode_material over jobs, in a process pool when asked for
+    and the jobs are large enough to pay for it, results come back in job
+    order
+    :param jobs:
+    :param processes: worker count, 0 for one per core, 1 to encode here
+    :return: generator of encode_material results
+    """
+    corner_count = sum(len(job["position"]) for job in jobs)
+    return spm_pool.map_jobs(spm_mesh.encode_material, jobs, processes, corner_count)
+
+
 def save(filename, context, export_settings, objects=[]):
     """
     Main exporter function
@@ -549,7 +979,6 @@ def save(filename, context, export_settings, objects=[]):
     :return:
     """
 
-    bounding_boxes = [99999999.0, 0.0, 0.0, 0.0, 0.0, 0.0]
     import time
     start = time.time()
     if objects:
@@ -580,9 +1009,8 @@ def save(filename, context, export_settings, objects=[]):
     if arm_count != 0:
         bpy.context.scene.frame_set(static_mesh_frame)
 
-    all_no_uv_one = True
+    evaluated = []
     for obj in exp_obj:
-        tangents_triangles_dict = {}
         if obj.type != "MESH":
             continue
 
@@ -590,13 +1018,35 @@ def save(filename, context, export_settings, objects=[]):
             mesh_matrix = mathutils.Matrix()
         else:
             mesh_matrix = obj.matrix_world.copy()
-        exported_matrix = axis_conversion * mesh_matrix
 
-        arm = obj.find_armature()
         mesh = obj.to_mesh(context.scene, export_settings.get("apply-modifiers"), 'PREVIEW', False)
         if not mesh.vertices:
             print('{} has no vertices, please check it'.format(obj.name))
             continue
+        evaluated.append((obj, mesh, mesh_matrix))
+
+    # Animations are not part of the key, so skinned meshes are never cached.
+    # An empty folder or a zero size disables the cache
+    spm_cache = None
+    if export_settings.get("cache-dir") and export_settings.get("cache-size") and arm_count == 0:
+        spm_cache = SPMCache(export_settings.get("cache-dir"), export_settings.get("cache-size") * 1024 * 1024)
+        input_files = []
+        if export_settings.get("native-spm"):
+            # make_spm reads the materials.xml next to the output
+            input_files.append(os.path.join(os.path.dirname(filename), "materials.xml"))
+        hasher = new_key_hasher(export_settings, input_files)
+        for obj, mesh, mesh_matrix in evaluated:
+            hash_export_object(hasher, obj, mesh, None if export_settings.get("local-space") else mesh_matrix)
+        cache_key = hasher.hexdigest()
+        if spm_cache.restore(cache_key, filename):
+            end = time.time()
+            print("Restored from the SPM cache in", (end - start))
+            return {'FINISHED'}
+
+    all_no_uv_one = True
+    for obj, mesh, mesh_matrix in evaluated:
+        exported_matrix = axis_conversion * mesh_matrix
+        arm = obj.find_armature()
 
         bm = bmesh.new()
         bm.from_mesh(mesh)
@@ -607,19 +1057,18 @@ def save(filename, context, export_settings, objects=[]):
         bm.to_mesh(mesh)
         bm.free()
 
-        mesh.calc_tessface()
-        if not mesh.tessfaces:
+        if not mesh.polygons:
             print('{} has no faces, please check it'.format(obj.name))
             continue
 
         uv_one = True
         uv_two = True
-        if len(mesh.tessface_uv_textures) > 1:
-            if mesh.tessface_uv_textures.active is None:
+        if len(mesh.uv_textures) > 1:
+            if mesh.uv_textures.active is None:
                 uv_one = False
                 uv_two = False
-        elif len(mesh.tessface_uv_textures) > 0:
-            if mesh.tessface_uv_textures.active is None:
+        elif len(mesh.uv_textures) > 0:
+            if mesh.uv_textures.active is None:
                 uv_one = False
                 uv_two = False
             else:
@@ -629,165 +1078,75 @@ def save(filename, context, export_settings, objects=[]):
             uv_two = False
 
         # Smooth tangents ourselves
-        for poly in mesh.polygons:
-            poly.use_smooth = False
+        mesh.polygons.foreach_set("use_smooth", np.zeros(len(mesh.polygons), dtype=bool))
 
         if uv_one and need_export_tangent:
             if all_no_uv_one:
                 all_no_uv_one = False
-            mesh.calc_tangents()
-            for poly in mesh.polygons:
-                # Because of triangulated
-                assert (len(poly.loop_indices) == 3)
-                poly_tri = Triangle()
-                for li in poly.loop_indices:
-                    poly_tri.m_position.append(mesh.vertices[mesh.loops[li].vertex_index].co)
-                    loc_tan = mathutils.Vector(mesh.loops[li].tangent)
-                    loc_tan.normalize()
-                    poly_tri.m_tangent.append((loc_tan[0], loc_tan[1], loc_tan[2], mesh.loops[li].bitangent_sign))
-
-                poly_tri.set_hash_string()
-                tangents_triangles_dict[poly_tri] = poly_tri.m_tangent
-
-        for i, f in enumerate(mesh.tessfaces):
-            texture_one = ""
-            texture_two = ""
-            if uv_one:
-                if mesh.tessface_uv_textures[0].data[i].image is not None:
-                    texture_one = os.path.basename(mesh.tessface_uv_textures[0].data[i].image.filepath)
-
-            if uv_two:
-                if mesh.tessface_uv_textures[1].data[i].image is not None:
-                    texture_two = os.path.basename(mesh.tessface_uv_textures[1].data[i].image.filepath)
-
-            texture_cmp = ''.join([texture_one, texture_two])
-            vertex_list = []
-            for j, v in enumerate(f.vertices):
-                vertices = mesh.vertices[v].co
-                if bounding_boxes[0] == 99999999.0:
-                    bounding_boxes[0] = vertices[0]
-                    bounding_boxes[1] = vertices[1]
-                    bounding_boxes[2] = vertices[2]
-                    bounding_boxes[3] = vertices[0]
-                    bounding_boxes[4] = vertices[1]
-                    bounding_boxes[5] = vertices[2]
-                else:
-                    # Min edge
-                    if bounding_boxes[0] > vertices[0]:
-                        bounding_boxes[0] = vertices[0]
-                    if bounding_boxes[1] > vertices[1]:
-                        bounding_boxes[1] = vertices[1]
-                    if bounding_boxes[2] > vertices[2]:
-                        bounding_boxes[2] = vertices[2]
-
-                    # Max edge
-                    if bounding_boxes[3] < vertices[0]:
-                        bounding_boxes[3] = vertices[0]
-                    if bounding_boxes[4] < vertices[1]:
-                        bounding_boxes[4] = vertices[1]
-                    if bounding_boxes[5] < vertices[2]:
-                        bounding_boxes[5] = vertices[2]
-
-                nor_vec = mathutils.Vector(mesh.vertices[v].normal)
-                nor_vec.normalize()
-                all_uvs = [0.0, 0.0, 0.0, 0.0]
-                if uv_one:
-                    all_uvs[0] = mesh.tessface_uv_textures[0].data[i].uv[j][0]
-                    all_uvs[1] = 1 - \
-                        mesh.tessface_uv_textures[0].data[i].uv[j][1]
-                if uv_two:
-                    all_uvs[2] = mesh.tessface_uv_textures[1].data[i].uv[j][0]
-                    all_uvs[3] = 1 - \
-                        mesh.tessface_uv_textures[1].data[i].uv[j][1]
-
-                vertex_color = [255, 255, 255]
-                if len(mesh.tessface_vertex_colors) > 0:
-                    if has_vertex_color is False:
-                        has_vertex_color = True
-
-                    if j == 0:
-                        vcolor = mesh.tessface_vertex_colors[0].data[f.index].color1
-                    elif j == 1:
-                        vcolor = mesh.tessface_vertex_colors[0].data[f.index].color2
-                    elif j == 2:
-                        vcolor = mesh.tessface_vertex_colors[0].data[f.index].color3
-                    elif j == 3:
-                        vcolor = mesh.tessface_vertex_colors[0].data[f.index].color4
-                    vertex_color = [
-                        min(int(vcolor.r * 255), 255),
-                        min(int(vcolor.g * 255), 255),
-                        min(int(vcolor.b * 255), 255)
-                    ]
-
-                each_joint_data = []
-                if arm_count != 0:
-                    for group in mesh.vertices[v].groups:
-                        each_joint_data.append((obj.vertex_groups[group.group].name, group.weight))
-                    each_joint_data.sort(key=lambda x: x[1], reverse=True)
-                vertex_list.append((vertices, nor_vec, vertex_color, all_uvs, each_joint_data))
-
-            t1 = Triangle()
-            # Because of triangulated
-            assert (len(vertex_list) == 3)
-            for vertex in vertex_list:
-                t1.m_position.append(vertex[0])
-                t1.m_normal.append(vertex[1])
-                t1.m_color.append(vertex[2])
-                t1.m_all_uvs.append(vertex[3])
-                t1.m_all_joints_weights.append(vertex[4])
-
-            t1.m_texture_one = texture_one
-            t1.m_texture_two = texture_two
-            t1.m_texture_cmp = texture_cmp
-            t1.m_armature_name = arm.data.name if arm is not None else "NULL"
-            t1.set_hash_string()
-            if t1 in tangents_triangles_dict:
-                t1.m_tangent = tangents_triangles_dict[t1]
-                # print("tangent:")
-                # print(t1.m_tangent)
-            else:
-                if need_export_tangent and uv_one:
-                    print("Missing a triangle from loop map")
-                t1.m_tangent = [(0.0, 0.0, 0.0, 1.0), (0.0, 0.0, 0.0, 1.0), (0.0, 0.0, 0.0, 1.0)]
-            all_triangles.append(t1)
 
-        if need_export_tangent:
-            mesh.free_tangents()
+        if len(mesh.vertex_colors) > 0:
+            if has_vertex_color is False:
+                has_vertex_color = True
+
+        all_triangles.append(extract_triangles(obj, mesh, uv_one, uv_two, need_export_tangent, arm_count != 0, arm))
 
     if need_export_tangent and all_no_uv_one:
         print('{} (one of the object in the list) have no uvmap'.format(exp_obj[0].name))
         need_export_tangent = False
 
+    assert len(all_triangles) > 0
+    triangles = TriangleArrays.concatenate(all_triangles)
+    all_triangles = None
+
+    # Sampling walks the whole timeline, it is done once for whichever of
+    # make_spm or the python exporter writes the file
+    armatures_sampled = False
+    if export_settings.get("native-spm"):
+        binary = find_make_spm(export_settings)
+        if binary is None:
+            print("make_spm not found, using the python exporter")
+        elif need_export_tangent:
+            # make_spm writes a tangent and a bitangent, 8 bytes per vertex,
+            # instead of the packed 4 byte tangent STK and spm_reader expect
+            print("make_spm can not write packed tangents, using the python exporter")
+        else:
+            if arm_count != 0:
+                sample_armatures([arm_dict[arm_name] for arm_name in sorted(arm_dict.keys())], export_settings)
+                armatures_sampled = True
+            flags = (
+                export_settings.get("do-sp") and arm_count == 0, export_settings.get("export-normal"),
+                export_settings.get("export-vcolor") and has_vertex_color
+            )
+            if export_native(binary, filename, triangles, arm_dict, export_settings, static_mesh_frame, flags):
+                if spm_cache is not None:
+                    spm_cache.store(cache_key, filename)
+                end = time.time()
+                print("Exported in", (end - start))
+                return {'FINISHED'}
+
     if arm_count != 0:
         ExportArm.m_accumulated_bone = 0
         for arm_name in sorted(arm_dict.keys()):
-            arm_dict[arm_name].build_index(all_triangles)
+            arm_dict[arm_name].build_index(triangles)
             arm_dict[arm_name].build_local_id()
 
-        useless_arm = True
-        for triangle in all_triangles:
-            for i in range(0, 3):
-                total_weights = sum(triangle.m_all_weights[i])
-                if total_weights > 0.0:
-                    useless_arm = False
-                    for j in range(0, 4):
-                        triangle.m_all_weights[i][j] /= total_weights
-        if useless_arm:
+        total_weights = triangles.m_all_weights.sum(axis=2)
+        weighted = total_weights > 0.0
+        triangles.m_all_weights[weighted] /= total_weights[weighted][:, None]
+        if not weighted.any():
             arm_count = 0
 
-    assert len(all_triangles) > 0
-    all_triangles.sort(key=lambda x: x.m_texture_cmp)
-    spm_buffer = bytearray()
+    assert len(triangles) > 0
+    triangles = triangles.sort_by_material(export_settings.get("morton-order"))
 
-    # SP header
-    spm_buffer += write_uint16(20563)
+    # Skinned mesh can't be space partitioned
+    do_sp = export_settings.get("do-sp") and arm_count == 0
 
     # 5 bit version, 3 bit type : SPMS SPMA SPMN
-    # SPMS (space partitioned split mesh not supported in python)
     byte = 0
     byte = SPM_VERSION << 3
-    byte |= 1 if arm_count != 0 else 2
-    spm_buffer += write_uint8(byte)
+    byte |= 1 if arm_count != 0 else 0 if do_sp else 2
+    type_byte = byte
 
     # bit 0: export-normal
     # bit 1: export-vcolor
@@ -801,115 +1160,99 @@ def save(filename, context, export_settings, objects=[]):
         byte = 1 << 1 | byte
     if need_export_tangent:
         byte = 1 << 2 | byte
-    spm_buffer += write_uint8(byte)
-    for position in bounding_boxes:
-        spm_buffer += write_float(position)
-
-    tex_cmp = "NULL"
-    texture_list = []
-    for triangle in all_triangles:
-        if triangle.m_texture_cmp != tex_cmp:
-            tex_cmp = triangle.m_texture_cmp
-            texture_list.append(triangle.m_texture_one)
-            texture_list.append(triangle.m_texture_two)
-    material_count = len(texture_list) >> 1
-    spm_buffer += write_uint16(material_count)
-    # print(material_count)
-    for texture_name in texture_list:
-        spm_buffer += write_len_string(texture_name)
-
-    # No SPMS so always 1 sector count
-    spm_buffer += write_uint16(1)
-
-    vbo_ibo = bytearray()
-    vertices_dict = {}
-    vertices = []
-    indices = []
-    tex_cmp = all_triangles[0].m_texture_cmp
-    material_count = 0
-    mesh_buffer_count = 0
-    Vertex.m_cmp_joint = arm_count != 0
-    export_normal = export_settings.get("export-normal")
+    flags_byte = byte
 
-    for t_idx in range(0, len(all_triangles) + 1):
-        cur_cmp = all_triangles[t_idx].m_texture_cmp \
-            if t_idx < len(all_triangles) else "NULL"
-
-        if cur_cmp != tex_cmp or len(vertices) > 65532:
-            tex_cmp = cur_cmp
-            vbo_ibo += write_uint(len(vertices))
-            vbo_ibo += write_uint(len(indices))
-            vbo_ibo += write_uint16(material_count)
-            # print(len(vertices))
-            # print(len(indices))
-            assert len(vertices) < 65536
-
-            for vertex in vertices:
-                if need_export_tangent:
-                    tangent = mathutils.Vector((0.0, 0.0, 0.0))
-                    bitangent_sign = vertices_dict.get(vertex)[1][0][3]
-                    #print("All tangents accumlated:")
-                    # print(vertices_dict.get(vertex)[1])
-                    for each_tan in vertices_dict.get(vertex)[1]:
-                        tangent = tangent +\
-                            mathutils.Vector(
-                                (each_tan[0], each_tan[1], each_tan[2]))
-
-                    tangent.normalize()
-                    vertex.m_tangent = (tangent[0], tangent[1], tangent[2], bitangent_sign)
-
-                vbo_ibo += vertex.write_vertex(
-                    all_triangles[t_idx - 1].m_texture_one != "",
-                    all_triangles[t_idx - 1].m_texture_two != "",
-                    export_vcolor,
-                    arm_count != 0,
-                    need_export_tangent,
-                    export_normal=export_normal
-                )
+    texture_list = [texture for textures in triangles.m_materials for texture in textures]
 
-            for index in indices:
-                if len(vertices) > 255:
-                    vbo_ibo += write_uint16(index)
-                else:
-                    vbo_ibo += write_uint8(index)
-
-            if not len(vertices) > 65532:
-                material_count = material_count + 1
-
-            mesh_buffer_count += 1
-            vertices_dict = {}
-            vertices = []
-            indices = []
-
-        if t_idx >= len(all_triangles):
-            break
-
-        triangle = all_triangles[t_idx]
-        assert len(triangle.m_position) == 3
-        vertices_list = triangle.get3_vertices()
-        for i in range(0, 3):
-            vertex = vertices_list[i]
-            if vertex not in vertices_dict:
-                vertex_location = len(vertices)
-                indices.append(vertex_location)
-                vertices.append(vertex)
-                vertices_dict[vertex] = [vertex_location, [vertex.m_tangent]]
-            else:
-                indices.append(vertices_dict[vertex][0])
-                vertices_dict[vertex][1].append(vertex.m_tangent)
-
-    spm_buffer += write_uint16(mesh_buffer_count)
-    spm_buffer += vbo_ibo
+    if do_sp:
+        centroids = triangles.m_position.mean(axis=1)
+        if export_settings.get("sp-partition") == "OCTREE":
+            sector_ids = spm_mesh.partition_octree(centroids, export_settings.get("sp-sector-triangles"))
+        else:
+            sector_ids = spm_mesh.partition_grid(centroids, export_settings.get("sp-sector-size"))
+        # Stable, so triangles stay sorted by material inside each sector
+        sector_order = np.argsort(sector_ids, kind='stable')
+        sector_ends = np.cumsum(np.bincount(sector_ids)).tolist()
+        sectors = [sector_order[s:e] for s, e in zip([0] + sector_ends[:-1], sector_ends)]
+        assert len(sectors) < 65536
+        print("{} sectors".format(len(sectors)))
+    else:
+        sectors = [None]
 
-    if arm_count != 0:
-        spm_buffer += write_uint8(len(arm_dict))
-        spm_buffer += write_uint16(static_mesh_frame - 1)
-        for arm_name in sorted(arm_dict.keys()):
-            spm_buffer += arm_dict[arm_name].write_armature(export_settings)
+    write_joints = arm_count != 0
+    export_normal = export_settings.get("export-normal")
 
-    spm = open(filename, 'wb')
-    spm.write(spm_buffer)
-    spm.close()
+    if arm_count != 0 and not armatures_sampled:
+        sample_armatures([arm_dict[arm_name] for arm_name in sorted(arm_dict.keys())], export_settings)
+
+    # Everything up to here needs bpy, the mesh buffers are encoded from
+    # plain arrays, possibly in parallel
+    jobs = []
+    sector_job_counts = []
+    for sector in sectors:
+        sector_triangles = triangles if sector is None else triangles.take(sector)
+        sector_jobs = build_material_jobs(
+            sector_triangles, export_vcolor, write_joints, need_export_tangent, export_normal,
+            export_settings.get("optimize-mesh"), export_settings.get("morton-order")
+        )
+        sector_job_counts.append(len(sector_jobs))
+        jobs += sector_jobs
+
+    # The flags are shared by every mesh buffer, the vertex color flag is only
+    # dropped from the header when no material needs it. Tangents are only
+    # written with a first uv set, all_no_uv_one already cleared their flag.
+    # The second uv set has no flag, it is written whenever the material has
+    # a second texture, so it can only be reported
+    colors_pruned = False
+    if export_settings.get("prune-attributes"):
+        redundant = [spm_mesh.find_redundant_attributes(job) for job in jobs]
+        for job, attributes in zip(jobs, redundant):
+            if "uv_two" in attributes:
+                print(
+                    "Material {} ({}): uv two is identical to uv one, a single texture layer would save 4 bytes "
+                    "per vertex".format(job["material_id"], triangles.m_materials[job["material_id"]][1])
+                )
+        if flags_byte & 1 << 1 and all("color" in attributes for attributes in redundant):
+            colors_pruned = True
+            flags_byte &= ~(1 << 1)
+            for job in jobs:
+                job["vcolor"] = False
+    results = encode_material_jobs(jobs, export_settings.get("encode-processes", 1))
+
+    vertex_count = 0
+    spm = SPMWriter(filename)
+    with spm:
+        spm.write_header(type_byte, flags_byte)
+        spm.write_materials(texture_list)
+
+        spm.write(write_uint16(len(sectors)))
+        for job_count in sector_job_counts:
+            spm.begin_mesh_buffers()
+            for _ in range(0, job_count):
+                buffers, messages = next(results)
+                for message in messages:
+                    print(message)
+                for data, positions in buffers:
+                    spm.write_mesh_buffer(data, positions)
+                    vertex_count += len(positions)
+            spm.end_mesh_buffers(write_bounding_box=do_sp)
+
+        if do_sp:
+            # Reserved for pre-computed visible sectors
+            spm.write(write_uint16(0))
+
+        if arm_count != 0:
+            spm.write(write_uint8(len(arm_dict)))
+            spm.write(write_uint16(static_mesh_frame - 1))
+            for arm_name in sorted(arm_dict.keys()):
+                spm.write(arm_dict[arm_name].write_armature(export_settings))
+
+    # White vertices stored their color in a single byte
+    if colors_pruned:
+        print("All vertex colors are white, dropped them: {} bytes saved".format(vertex_count))
+
+    if spm_cache is not None:
+        spm_cache.store(cache_key, filename)
 
     end = time.time()
     print("Exported in", (end - start))
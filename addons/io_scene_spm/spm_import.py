@@ -21,245 +21,296 @@
 # SOFTWARE.
 
 import bpy
-import bpy_extras
-import struct
-import bmesh
 import os
-import sys
+import numpy as np
 from bpy_extras.image_utils import load_image
 
-SPM_VERSION = 1
+from . import spm_pool
+from . import spm_reader
 
+# Integer face layer holding the index of the mesh buffer each face came
+# from, written when buffers are merged into one mesh
+MESH_BUFFER_LAYER = "spm_mesh_buffer"
 
-def reinterpret_cast_int_to_float(int_val):
-    return struct.unpack('f', struct.pack('I', int_val))[0]
+# Files written by the exporter took 25 to 30 bytes per triangle corner,
+# welded meshes take fewer, so the corner count estimated from the file size
+# errs towards decoding in process
+BYTES_PER_CORNER = 25
 
 
-def decompress_half_float(raw_bytes):
-    if sys.version_info[0] == 3 and sys.version_info[1] > 5:
-        return struct.unpack("<e", raw_bytes)[0]
-    else:
-        float16 = int(struct.unpack('<H', raw_bytes)[0])
-
-        # sign
-        s = (float16 >> 15) & 0x00000001
-        # exponent
-        e = (float16 >> 10) & 0x0000001f
-        # fraction
-        f = float16 & 0x000003ff
-
-        if e == 0:
-            if f == 0:
-                return reinterpret_cast_int_to_float(int(s << 31))
-            else:
-                while not (f & 0x00000400):
-                    f = f << 1
-                    e -= 1
-                e += 1
-                f &= ~0x00000400
-
-        elif e == 31:
-            if f == 0:
-                return reinterpret_cast_int_to_float(int((s << 31) | 0x7f800000))
-            else:
-                return reinterpret_cast_int_to_float(int((s << 31) | 0x7f800000 | (f << 13)))
-
-        e = e + (127 - 15)
-        f = f << 13
-        return reinterpret_cast_int_to_float(int((s << 31) | (e << 23) | f))
-
-
-def generate_mesh_buffer(
-    spm, vertices_count, indices_count, read_normal, read_vcolor, read_tangent, uv_one, uv_two, is_skinned,
-    material_map, material_id
-):
-    obj_name =\
+def get_material_name(material_map, material_id):
+    return \
         (material_map[material_id][2] if material_map[material_id][2] else "_") +\
         "_" +\
         (material_map[material_id][3] if material_map[material_id][3] else "_")
+
+
+def get_material(material_map, material_id):
+    name = get_material_name(material_map, material_id)
+    material = bpy.data.materials.get(name)
+    if material is None:
+        material = bpy.data.materials.new(name)
+    return material
+
+
+def generate_mesh(obj_name, parts, material_map, merged=False):
+    """
+    Create one object from decoded mesh buffers, the whole mesh is filled
+    with foreach_set instead of adding vertices and faces one by one
+    :param obj_name:
+    :param parts: list of (mesh buffer index in the file, material id, dict
+                  from spm_reader.SPMMeshBuffer.get_blender_arrays)
+    :param material_map:
+    :param merged: give the mesh a material slot per material and record
+                   the mesh buffer of each face in MESH_BUFFER_LAYER
+    :return: the object
+    """
     mesh = bpy.data.meshes.new(obj_name)
     obj = bpy.data.objects.new(obj_name, mesh)
-    bm = bmesh.new()
-    bm.from_mesh(mesh)
-
-    vertices_list = []
-    idx_size =\
-        4 if vertices_count > 65535 else 2 if vertices_count > 255 else 1
-    for vert in range(0, vertices_count):
-        vc = None
-        u = 0.0
-        v = 0.0
-        u_2 = 0.0
-        v_2 = 0.0
-        x, y, z = struct.unpack('<fff', spm.read(12))
-        bm.verts.new((x, z, y))
-        if read_normal:
-            # Unused, auto re-calculate later
-            spm.read(4)
-
-        if read_vcolor:
-            # Color identifier
-            ci = struct.unpack('<B', spm.read(1))[0]
-            if ci == 128:
-                # All white
-                vc = [1.0, 1.0, 1.0]
-            else:
-                r, g, b = struct.unpack('<BBB', spm.read(3))
-                vc = [r / 255.0, g / 255.0, b / 255.0]
-
-        if uv_one:
-            u = decompress_half_float(spm.read(2))
-            v = decompress_half_float(spm.read(2))
-            v = 1.0 - v
-            if uv_two:
-                u_2 = decompress_half_float(spm.read(2))
-                v_2 = decompress_half_float(spm.read(2))
-                v_2 = 1.0 - v_2
-            if read_tangent:
-                # Unused
-                spm.read(4)
-
-        if is_skinned:
-            # Unused
-            spm.read(16)
-        vertices_list.append((vc, (u, v, u_2, v_2)))
-
-    indices_list = None
-    if idx_size == 4:
-        indices_list = struct.unpack("%dI" % (indices_count, ), spm.read(indices_count * idx_size))
-    elif idx_size == 2:
-        indices_list = struct.unpack("%dH" % (indices_count, ), spm.read(indices_count * idx_size))
-    else:
-        indices_list = struct.unpack("%dB" % (indices_count, ), spm.read(indices_count * idx_size))
-
-    # Required after adding / removing vertices and before accessing them
-    # by index.
-    bm.verts.ensure_lookup_table()
-    # Required to actually retrieve the indices later on (or they stay -1).
-    bm.verts.index_update()
-    for i in range(0, len(indices_list), 3):
-        try:
-            bm.faces.new(bm.verts[j] for j in reversed(indices_list[i:i + 3]))
-        except:
-            # Face already exists
-            continue
 
-    if read_vcolor:
-        color_layer = bm.loops.layers.color.new()
-    if uv_one:
-        uv_layer = bm.loops.layers.uv.new()
-        tex_layer = bm.faces.layers.tex.new()
-    if uv_two:
-        uv_layer_two = bm.loops.layers.uv.new()
-        tex_layer_two = bm.faces.layers.tex.new()
-
-    for face in bm.faces:
-        if uv_one:
-            face[tex_layer].image = material_map[material_id][0]
-        if uv_two:
-            face[tex_layer_two].image = material_map[material_id][1]
-        for loop in face.loops:
-            if read_vcolor:
-                loop[color_layer] = vertices_list[loop.vert.index][0]
-            if uv_one:
-                loop[uv_layer].uv = (vertices_list[loop.vert.index][1][0], vertices_list[loop.vert.index][1][1])
-            if uv_two:
-                loop[uv_layer_two].uv = (vertices_list[loop.vert.index][1][2], vertices_list[loop.vert.index][1][3])
-
-    bmesh.ops.remove_doubles(bm, verts=bm.verts)
-    bm.to_mesh(mesh)
-    bm.free()
-
-    for poly in mesh.polygons:
-        poly.use_smooth = True
+    vertex_counts = [len(arrays["vertices"]) for _, _, arrays in parts]
+    vertex_offsets = np.cumsum([0] + vertex_counts[:-1])
+    face_counts = [len(arrays["loops"]) // 3 for _, _, arrays in parts]
+    loop_count = sum(face_counts) * 3
+    face_count = sum(face_counts)
+    mesh.vertices.add(sum(vertex_counts))
+    mesh.vertices.foreach_set("co", np.concatenate([arrays["vertices"] for _, _, arrays in parts]).ravel())
+    mesh.loops.add(loop_count)
+    loops = [arrays["loops"] + offset for (_, _, arrays), offset in zip(parts, vertex_offsets)]
+    mesh.loops.foreach_set("vertex_index", np.concatenate(loops).astype(np.int32))
+    mesh.polygons.add(face_count)
+    mesh.polygons.foreach_set("loop_start", np.arange(0, loop_count, 3, dtype=np.int32))
+    mesh.polygons.foreach_set("loop_total", np.full(face_count, 3, dtype=np.int32))
+    mesh.polygons.foreach_set("use_smooth", np.ones(face_count, dtype=bool))
+
+    # Buffers of materials without texture have no uvs
+    for layer, field in ((0, "uv_one"), (1, "uv_two")):
+        if not any(field in arrays for _, _, arrays in parts):
+            continue
+        uv_texture = mesh.uv_textures.new()
+        mesh.uv_layers[layer].data.foreach_set(
+            "uv",
+            np.concatenate(
+                [
+                    arrays[field] if field in arrays else np.zeros((len(arrays["loops"]), 2), dtype=np.float32)
+                    for _, _, arrays in parts
+                ]
+            ).ravel()
+        )
+        face_images = []
+        for (_, material_id, _), count in zip(parts, face_counts):
+            face_images += [material_map[material_id][layer]] * count
+        for face, image in zip(uv_texture.data, face_images):
+            if image is not None:
+                face.image = image
+
+    if any("color" in arrays for _, _, arrays in parts):
+        mesh.vertex_colors.new().data.foreach_set(
+            "color",
+            np.concatenate(
+                [
+                    arrays["color"] if "color" in arrays else np.ones((len(arrays["loops"]), 3), dtype=np.float32)
+                    for _, _, arrays in parts
+                ]
+            ).ravel()
+        )
+
+    if merged:
+        material_ids = []
+        for _, material_id, _ in parts:
+            if material_id not in material_ids:
+                material_ids.append(material_id)
+                mesh.materials.append(get_material(material_map, material_id))
+        mesh.polygons.foreach_set(
+            "material_index",
+            np.repeat([material_ids.index(material_id) for _, material_id, _ in parts], face_counts).astype(np.int32)
+        )
+        mesh.polygon_layers_int.new(MESH_BUFFER_LAYER).data.foreach_set(
+            "value",
+            np.repeat([buffer_index for buffer_index, _, _ in parts], face_counts).astype(np.int32)
+        )
+
+    # Drops the duplicated and degenerate faces bmesh used to refuse
+    mesh.validate()
+    mesh.update()
 
     bpy.context.scene.objects.link(obj)
-
-
-def get_image(tex_name, working_directory, extra_tex_path):
-    # Try in loaded images first:
-    for image in bpy.data.images:
-        if tex_name == os.path.basename(image.filepath):
+    return obj
+
+
+class TextureIndex:
+    """
+    Basename to path index of every file under a texture directory, a file
+    name found in several directories maps to the first one os.walk visits
+    """
+
+    def __init__(self, root):
+        self.m_root = root
+        self.m_paths = {}
+        # mtime of each walked directory, None for a missing root
+        self.m_directory_mtimes = {root: None}
+        for directory, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            self.m_directory_mtimes[directory] = os.stat(directory).st_mtime
+            for filename in sorted(filenames):
+                self.m_paths.setdefault(filename, os.path.join(directory, filename))
+
+    def is_stale(self):
+        """
+        Adding, removing or renaming a file changes the mtime of its directory
+        :return: True if the index needs to be rebuilt
+        """
+        for directory, mtime in self.m_directory_mtimes.items():
+            try:
+                if os.stat(directory).st_mtime != mtime:
+                    return True
+            except OSError:
+                if mtime is not None:
+                    return True
+        return False
+
+    def find(self, tex_name):
+        return self.m_paths.get(tex_name)
+
+
+# Texture indices by root directory, kept for the whole Blender session
+texture_indices = {}
+
+
+def get_texture_index(root):
+    index = texture_indices.get(root)
+    if index is None or index.is_stale():
+        index = TextureIndex(root)
+        texture_indices[root] = index
+    return index
+
+
+class TextureResolver:
+    """
+    Finds the image of a texture name in the loaded images, next to the
+    imported file, then in the extra texture paths. The paths are indexed
+    once instead of walked for every texture
+    """
+
+    def __init__(self, extra_tex_path):
+        """
+        :param extra_tex_path: directories separated by ;;
+        """
+        self.m_indices = [
+            get_texture_index(bpy.path.abspath(path.strip())) for path in extra_tex_path.split(";;") if path.strip()
+        ]
+        self.m_images = {}
+        for image in bpy.data.images:
+            self.m_images.setdefault(os.path.basename(image.filepath), image)
+        # (working directory, texture name) already looked up in vain
+        self.m_missing = set()
+
+    def get_image(self, tex_name, working_directory):
+        image = self.m_images.get(tex_name)
+        if image is not None or (working_directory, tex_name) in self.m_missing:
             return image
 
-    # Try local directory first
-    img = bpy_extras.image_utils.load_image(tex_name, working_directory)
-    if img is not None:
-        return img
-    img = bpy_extras.image_utils.load_image(tex_name, extra_tex_path, recursive=True)
-    if img is not None:
-        return img
-    else:
-        print("Missing image %s" % tex_name)
-    return None
-
-
-def load(context, filepath, extra_tex_path):
-    spm = open(filepath, 'rb')
-
-    sp_header = spm.read(2)
-    if sp_header != b'SP':
-        print('%s is not a valid spm file' % filepath)
-        spm.close()
-        return
-
-    byte = struct.unpack('<B', spm.read(1))[0]
-    version = byte >> 3
-    if version != SPM_VERSION:
-        print('%d unsupported version' % version)
-        spm.close()
-        return
-
-    byte &= ~0x08
-    header = None
-    if byte == 0:
-        header = "SPMS"
-    elif byte == 1:
-        header = "SPMA"
-    else:
-        header = "SPMN"
-
-    byte = struct.unpack('<B', spm.read(1))[0]
-    read_normal = byte & 0x01
-    read_vcolor = byte >> 1 & 0x01
-    read_tangent = byte >> 2 & 0x01
-    is_skinned = header == "SPMA"
-
-    # Skip useless bounding box
-    spm.read(24)
-    material_count = struct.unpack('<H', spm.read(2))[0]
-    material_map = []
+        # Try local directory first
+        path = os.path.join(working_directory, tex_name)
+        if not os.path.isfile(path):
+            path = None
+            for index in self.m_indices:
+                path = index.find(tex_name)
+                if path is not None:
+                    break
+
+        image = load_image(path) if path is not None else None
+        if image is None:
+            print("Missing image %s" % tex_name)
+            self.m_missing.add((working_directory, tex_name))
+            return None
+        self.m_images[tex_name] = image
+        return image
+
+
+def decode_files(filepaths, weld_vertices, processes=1):
+    """
+    Run spm_reader.decode_file over filepaths, in a process pool when asked
+    for and the files are large enough to pay for it, results come back in
+    file order
+    :param filepaths:
+    :param weld_vertices:
+    :param processes: worker count, 0 for one per core, 1 to decode here
+    :return: generator of decode_file results
+    """
+    jobs = [(filepath, weld_vertices) for filepath in filepaths]
+    total_size = 0
+    for filepath in filepaths:
+        # decode_file reports the files it can not read
+        if os.path.isfile(filepath):
+            total_size += os.path.getsize(filepath)
+    return spm_pool.map_jobs(spm_reader.decode_file, jobs, processes, total_size // BYTES_PER_CORNER)
+
+
+def create_objects(decoded, resolver, filepath, layout="BUFFER"):
+    """
+    Create the objects of one decoded file, only this part needs bpy
+    :param decoded: dict from spm_reader.decode_file
+    :param resolver: TextureResolver
+    :param filepath: its directory is searched for textures first
+    :param layout: BUFFER for one object per mesh buffer, MATERIAL for one
+                   per material or MERGED for one per file
+    :return: list of objects
+    """
     working_directory = os.path.dirname(filepath)
-    for material in range(0, material_count):
-        tex_name_1 = None
-        tex_name_2 = None
-        tex_fname_1 = None
-        tex_fname_2 = None
-        tex_size = struct.unpack('<B', spm.read(1))[0]
-        if tex_size > 0:
-            tex_name_1 = spm.read(tex_size).decode('ascii')
-            tex_fname_1 = get_image(tex_name_1, working_directory, extra_tex_path)
-        tex_size = struct.unpack('<B', spm.read(1))[0]
-        if tex_size > 0:
-            tex_name_2 = spm.read(tex_size).decode('ascii')
-            tex_fname_2 = get_image(tex_name_2, working_directory, extra_tex_path)
-        material_map.append((tex_fname_1, tex_fname_2, tex_name_1, tex_name_2))
-
-    # Space partitioned mesh sector count, should be 1
-    sector_count = struct.unpack('<H', spm.read(2))[0]
-
-    for sector in range(0, sector_count):
-        material_count = struct.unpack('<H', spm.read(2))[0]
-        for material in range(0, material_count):
-            vertices_count = struct.unpack('<I', spm.read(4))[0]
-            indices_count = struct.unpack('<i', spm.read(4))[0]
-            material_id = struct.unpack('<H', spm.read(2))[0]
-            assert material_id < material_count
-            generate_mesh_buffer(
-                spm, vertices_count, indices_count, read_normal, read_vcolor, read_tangent,
-                material_map[material_id][2] is not None, material_map[material_id][3] is not None, is_skinned,
-                material_map, material_id
-            )
-        if header == "SPMS":
-            # Reserved, never used
-            spm.read(24)
+    material_map = []
+    for tex_name_1, tex_name_2 in decoded["materials"]:
+        tex_fname_1 = resolver.get_image(tex_name_1, working_directory) if tex_name_1 else None
+        tex_fname_2 = resolver.get_image(tex_name_2, working_directory) if tex_name_2 else None
+        material_map.append((tex_fname_1, tex_fname_2, tex_name_1 or None, tex_name_2 or None))
+
+    parts = [(i, material_id, arrays) for i, (material_id, arrays) in enumerate(decoded["mesh_buffers"])]
+    if not parts:
+        return []
+    if layout == "MERGED":
+        obj_name = os.path.splitext(os.path.basename(filepath))[0]
+        return [generate_mesh(obj_name, parts, material_map, True)]
+    if layout == "MATERIAL":
+        material_parts = {}
+        for part in parts:
+            material_parts.setdefault(part[1], []).append(part)
+        objects = []
+        for material_id in sorted(material_parts.keys()):
+            obj_name = get_material_name(material_map, material_id)
+            objects.append(generate_mesh(obj_name, material_parts[material_id], material_map, True))
+        return objects
+    return [generate_mesh(get_material_name(material_map, part[1]), [part], material_map) for part in parts]
+
+
+def load_files(
+    context, filepaths, extra_tex_path, weld_vertices=True, group_per_file=False, processes=1, layout="BUFFER"
+):
+    """
+    Import several files, they are parsed and decoded, in parallel for large
+    imports, while the objects are created here as results arrive, all files
+    share one texture resolver
+    :param context:
+    :param filepaths:
+    :param extra_tex_path: directories separated by ;;
+    :param weld_vertices:
+    :param group_per_file: link the objects of each file into a group named
+                           after it
+    :param processes: see decode_files
+    :param layout: see create_objects
+    :return:
+    """
+    resolver = TextureResolver(extra_tex_path)
+    for filepath, decoded in zip(filepaths, decode_files(filepaths, weld_vertices, processes)):
+        if decoded["error"] is not None:
+            print(decoded["error"])
+            continue
+
+        objects = create_objects(decoded, resolver, filepath, layout)
+        if group_per_file:
+            group = bpy.data.groups.new(os.path.splitext(os.path.basename(filepath))[0])
+            for obj in objects:
+                group.objects.link(obj)
+
+
+def load(context, filepath, extra_tex_path, weld_vertices=True, layout="BUFFER"):
+    load_files(context, [filepath], extra_tex_path, weld_vertices, layout=layout)
@@ -0,0 +1,618 @@
+#!BPY
+
+# Copyright (c) 2017 SPM author(s)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Mesh buffer processing shared by the SPM exporter, works on plain NumPy
+# arrays only so it does not depend on bpy
+
+import sys
+import numpy as np
+
+# Vertex attributes are welded on a grid of 1 / WELD_PRECISION
+WELD_PRECISION = 10000.0
+
+# A mesh buffer is split once it holds more vertices than this
+MAX_BUFFER_VERTICES = 65532
+
+# Post-transform vertex cache size the triangle order is optimized for
+VERTEX_CACHE_SIZE = 16
+
+
+def quantize(values):
+    return np.round(np.asarray(values, dtype=np.float64) * WELD_PRECISION).astype(np.int64)
+
+
+def build_weld_keys(position, normal, color, all_uvs, tangent, joints=None, weights=None):
+    """
+    Quantize the attributes of each corner into one integer row, corners with
+    equal rows are welded into the same vertex
+    :param position: (n, 3) corner positions
+    :param normal: (n, 3) corner normals
+    :param color: (n, 3) corner colors as integers
+    :param all_uvs: (n, 4) uv one and uv two
+    :param tangent: (n, 4) tangent and bitangent sign, only the sign is compared
+    :param joints: (n, 4) joint indices, or None to ignore joints and weights
+    :param weights: (n, 4) joint weights
+    :return: (n, k) int64 keys
+    """
+    columns = [
+        quantize(position),
+        quantize(normal),
+        np.asarray(color, dtype=np.int64),
+        quantize(all_uvs),
+        quantize(np.asarray(tangent)[:, 3:4])
+    ]
+    if joints is not None:
+        columns.append(np.asarray(joints, dtype=np.int64))
+        columns.append(quantize(weights))
+    return np.concatenate(columns, axis=1)
+
+
+def weld(keys):
+    """
+    Deduplicate rows of keys in one sort, vertices are numbered in order of
+    first use like the previous dictionary based welding
+    :param keys: (n, k) integer keys
+    :return: corner index of each unique vertex, index buffer of length n
+    """
+    keys = np.ascontiguousarray(keys)
+    rows = keys.view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1]))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    remap = np.empty_like(order)
+    remap[order] = np.arange(len(order))
+    return first[order], remap[inverse.ravel()]
+
+
+def split_buffer(keys, max_vertices=MAX_BUFFER_VERTICES):
+    """
+    Weld the corners of a run of triangles sharing one material into mesh
+    buffers, a new buffer is started after the triangle which makes the
+    current one hold more than max_vertices vertices
+    :param keys: (3 * triangle count, k) keys from build_weld_keys
+    :param max_vertices:
+    :return: list of (corner start, corner end, vertex corners, indices), the
+             vertex corners are relative to keys and indices to the buffer
+    """
+    _, vertex_class = weld(keys)
+    corner_count = len(vertex_class)
+
+    # Previous corner of the same class, a corner starts a new vertex in a
+    # buffer beginning at start when its previous occurrence is before start
+    order = np.argsort(vertex_class, kind='stable')
+    previous = np.full(corner_count, -1, dtype=np.int64)
+    same = vertex_class[order[1:]] == vertex_class[order[:-1]]
+    previous[order[1:][same]] = order[:-1][same]
+
+    local_id = np.empty(corner_count, dtype=np.int64)
+    buffers = []
+    start = 0
+    while start < corner_count:
+        is_new = previous[start:] < start
+        vertex_count = np.cumsum(is_new)[2::3]
+        over = np.flatnonzero(vertex_count > max_vertices)
+        end = corner_count if len(over) == 0 else start + (over[0] + 1) * 3
+
+        is_new = is_new[:end - start]
+        vertex_corners = np.flatnonzero(is_new)
+        local_id[vertex_class[vertex_corners + start]] = np.arange(len(vertex_corners))
+        indices = local_id[vertex_class[start:end]]
+        buffers.append((start, end, vertex_corners + start, indices))
+        start = end
+    return buffers
+
+
+def average_tangents(tangents, indices, vertex_corners):
+    """
+    Smooth the tangents of welded corners, the tangents of all corners using a
+    vertex are summed with a scatter-add and normalized, the bitangent sign
+    is the one of the vertex's first corner
+    :param tangents: (n, 4) tangent and bitangent sign of each corner
+    :param indices: (n,) vertex of each corner
+    :param vertex_corners: first corner of each vertex
+    :return: (vertex count, 4)
+    """
+    tangents = np.asarray(tangents, dtype=np.float64)
+    vertex_count = len(vertex_corners)
+    averaged = np.empty((vertex_count, 4), dtype=np.float64)
+    for i in range(0, 3):
+        averaged[:, i] = np.bincount(indices, weights=tangents[:, i], minlength=vertex_count)
+    length = np.linalg.norm(averaged[:, 0:3], axis=1)
+    averaged[length > 0.0, 0:3] /= length[length > 0.0, None]
+    averaged[:, 3] = tangents[vertex_corners, 3]
+    return averaged
+
+
+def cull_degenerate(indices, positions):
+    """
+    Find the triangles worth keeping, a triangle is dropped when welding made
+    two of its corners the same vertex or when its area is zero
+    :param indices: index buffer
+    :param positions: (vertex count, 3) vertex positions
+    :return: (triangle count,) bool mask of kept triangles
+    """
+    triangles = np.asarray(indices).reshape(-1, 3)
+    distinct = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) &\
+        (triangles[:, 0] != triangles[:, 2])
+    corners = np.asarray(positions, dtype=np.float64)[triangles]
+    cross = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    return distinct & (np.einsum("ij,ij->i", cross, cross) > 0.0)
+
+
+def average_cache_miss_ratio(indices, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Simulate a FIFO vertex cache, a vertex is still cached when less than
+    cache_size misses happened since it was loaded
+    :param indices: index buffer
+    :param cache_size:
+    :return: cache misses per triangle
+    """
+    if len(indices) == 0:
+        return 0.0
+    loaded = {}
+    misses = 0
+    for v in np.asarray(indices).tolist():
+        if misses - loaded.get(v, -cache_size) >= cache_size:
+            loaded[v] = misses
+            misses += 1
+    return misses / (len(indices) // 3)
+
+
+def tipsify(indices, vertex_count, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Reorder triangles for the vertex cache with Tipsify (Sander et al. 2007),
+    all triangles around a fanning vertex are emitted, then the next fanning
+    vertex is picked among the ones still in cache
+    :param indices: index buffer
+    :param vertex_count:
+    :param cache_size:
+    :return: triangle order
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    triangle_count = len(indices) // 3
+    # Triangles using each vertex
+    adjacency = (np.argsort(indices, kind='stable') // 3).tolist()
+    use_count = np.bincount(indices, minlength=vertex_count)
+    offsets = np.concatenate(([0], np.cumsum(use_count))).tolist()
+    live = use_count.tolist()
+    triangle_list = indices.reshape(-1, 3).tolist()
+
+    cache_time = [0] * vertex_count
+    emitted = [False] * triangle_count
+    dead_end = []
+    order = []
+    time = cache_size + 1
+    cursor = 0
+    fanning = int(indices[0]) if triangle_count else -1
+    while fanning >= 0:
+        candidates = []
+        for t in adjacency[offsets[fanning]:offsets[fanning + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            order.append(t)
+            for v in triangle_list[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - cache_time[v] > cache_size:
+                    cache_time[v] = time
+                    time += 1
+
+        # Prefer the candidate which stays longest in cache when its
+        # remaining triangles are emitted, one that would leave the cache
+        # first has priority 0 and loses to the dead-end stack
+        fanning = -1
+        best = 0
+        for v in candidates:
+            if live[v] > 0:
+                priority = 0
+                if time - cache_time[v] + 2 * live[v] <= cache_size:
+                    priority = time - cache_time[v]
+                if priority > best:
+                    best = priority
+                    fanning = v
+        if fanning == -1:
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fanning = v
+                    break
+        if fanning == -1:
+            while cursor < vertex_count:
+                if live[cursor] > 0:
+                    fanning = cursor
+                    break
+                cursor += 1
+    return np.array(order, dtype=np.int64)
+
+
+def reorder_vertices(indices):
+    """
+    Number vertices in the order the index buffer first fetches them,
+    unreferenced vertices are dropped
+    :param indices: index buffer
+    :return: old vertex of each new vertex, remapped index buffer
+    """
+    used, first = np.unique(indices, return_index=True)
+    vertex_order = used[np.argsort(first)]
+    remap = np.empty(used[-1] + 1 if len(used) else 0, dtype=np.int64)
+    remap[vertex_order] = np.arange(len(vertex_order))
+    return vertex_order, remap[indices]
+
+
+def optimize_buffer(indices, positions, cache_size=VERTEX_CACHE_SIZE):
+    """
+    Cull degenerate triangles, reorder triangles for the vertex cache and
+    vertices for fetch locality
+    :param indices: index buffer
+    :param positions: (vertex count, 3) vertex positions
+    :param cache_size:
+    :return: old vertex of each new vertex, new index buffer and
+             (culled triangle count, ACMR before, ACMR after)
+    """
+    acmr_before = average_cache_miss_ratio(indices, cache_size)
+    keep = cull_degenerate(indices, positions)
+    triangles = np.asarray(indices, dtype=np.int64).reshape(-1, 3)[keep]
+    if len(triangles):
+        triangles = triangles[tipsify(triangles.ravel(), len(positions), cache_size)]
+    vertex_order, indices = reorder_vertices(triangles.ravel())
+    acmr_after = average_cache_miss_ratio(indices, cache_size)
+    return vertex_order, indices, (len(keep) - int(keep.sum()), acmr_before, acmr_after)
+
+
+def pack_half_float(values):
+    """
+    Convert floats to half float bit patterns, rounded to nearest even like
+    struct.pack("<e"), or truncated on python < 3.6 which has no "<e"
+    :param values: array of any shape
+    :return: uint16 array of the same shape
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if sys.version_info[0] == 3 and sys.version_info[1] > 5:
+        # Same round to nearest even as struct.pack("<e")
+        return values.astype("<f2").view("<u2")
+
+    # Truncating conversion of the python < 3.6 fallback
+    f32 = values.astype(np.float32).view(np.uint32).astype(np.int64)
+    sign = (f32 >> 16) & 0x8000
+    exponent = ((f32 >> 23) & 0xff) - 127
+    mantissa = f32 & 0x007fffff
+    f16 = np.where(
+        exponent == 128, sign | 0x7c00 | (mantissa & 0x3ff),
+        np.where(
+            exponent > 15, sign | 0x7c00,
+            np.where(exponent > -15, sign | (exponent + 15) << 10 | (mantissa >> 13), sign)
+        )
+    )
+    return f16.astype("<u2")
+
+
+def pack_2101010_rev(vectors):
+    """
+    Pack normalized vectors into signed 10:10:10:2 words, clamped to [-1, 1]
+    and rounded half away from zero, a missing fourth component is written as 0
+    :param vectors: (n, 3) or (n, 4)
+    :return: (n,) uint32
+    """
+    vectors = np.asarray(vectors, dtype=np.float64)
+    # NaN is written as -1
+    v = np.where(np.isnan(vectors), -1.0, np.clip(vectors, -1.0, 1.0))
+    ret = np.zeros(len(v), dtype=np.uint32)
+    for i in range(0, 3):
+        part = np.where(v[:, i] > 0.0, np.trunc(v[:, i] * 511.0 + 0.5), np.trunc(v[:, i] * 512.0 - 0.5))
+        ret |= (part.astype(np.int64) & 1023).astype(np.uint32) << np.uint32(i * 10)
+    if v.shape[1] == 4:
+        part = np.where(v[:, 3] > 0.0, np.trunc(v[:, 3] * 1.0 + 0.5), np.trunc(v[:, 3] * 2.0 - 0.5))
+        ret |= (part.astype(np.int64) & 3).astype(np.uint32) << np.uint32(30)
+    return ret
+
+
+def unpack_2101010_rev(words):
+    """
+    Unpack signed 10:10:10:2 words written by pack_2101010_rev
+    :param words: uint32 array or little endian bytes
+    :return: (n, 4) float32, xyz in [-1, 1] and w in {-1, 0, 1}
+    """
+    if isinstance(words, (bytes, bytearray, memoryview)):
+        words = np.frombuffer(words, dtype="<u4")
+    words = np.asarray(words, dtype=np.int64)
+    ret = np.empty((len(words), 4), dtype=np.float32)
+    for i in range(0, 3):
+        part = (words >> (i * 10)) & 1023
+        part = np.where(part > 511, part - 1024, part)
+        ret[:, i] = np.where(part > 0, part / 511.0, part / 512.0)
+    part = (words >> 30) & 3
+    part = np.where(part > 1, part - 4, part)
+    ret[:, 3] = np.where(part > 0, part, part / 2.0)
+    return ret
+
+
+def get_vertex_dtype(export_normal, vcolor, uv_one, uv_two, export_tangent, write_joints, color_size=4):
+    """
+    Structured dtype of one vertex for the given header and material flags,
+    the color is 4 bytes by default and shrunk to 1 byte for white vertices
+    by encode_vertices
+    :param export_normal:
+    :param vcolor:
+    :param uv_one:
+    :param uv_two:
+    :param export_tangent:
+    :param write_joints:
+    :param color_size: 1 for the identifier byte of white vertices only
+    :return:
+    """
+    fields = [("position", "<f4", (3, ))]
+    if export_normal:
+        fields.append(("normal", "<u4"))
+    if vcolor:
+        fields.append(("color", "u1", (color_size, )))
+    if uv_one:
+        fields.append(("uv_one", "<f2", (2, )))
+        if uv_two:
+            fields.append(("uv_two", "<f2", (2, )))
+        if export_tangent:
+            fields.append(("tangent", "<u4"))
+    if write_joints:
+        fields.append(("joints", "<i2", (4, )))
+        fields.append(("weights", "<f2", (4, )))
+    return np.dtype(fields)
+
+
+def encode_vertices(
+    position, normal, color, all_uvs, tangent, joints, weights, uv_one, uv_two, vcolor, write_joints, export_tangent,
+    export_normal
+):
+    """
+    Serialize a whole vertex buffer in one go, byte for byte what writing each
+    vertex on its own used to produce
+    :return: bytes
+    """
+    dtype = get_vertex_dtype(export_normal, vcolor, uv_one, uv_two, export_tangent, write_joints)
+    vertices = np.zeros(len(position), dtype=dtype)
+    vertices["position"] = position
+    if export_normal:
+        vertices["normal"] = pack_2101010_rev(np.asarray(normal)[:, 0:3])
+    if vcolor:
+        white = (np.asarray(color) == 255).all(axis=1)
+        vertices["color"][:, 0] = np.where(white, 128, 255)
+        vertices["color"][:, 1:4] = color
+    if uv_one:
+        vertices["uv_one"].view("<u2")[:] = pack_half_float(np.asarray(all_uvs)[:, 0:2])
+        if uv_two:
+            vertices["uv_two"].view("<u2")[:] = pack_half_float(np.asarray(all_uvs)[:, 2:4])
+        if export_tangent:
+            vertices["tangent"] = pack_2101010_rev(tangent)
+    if write_joints:
+        vertices["joints"] = joints
+        vertices["weights"].view("<u2")[:] = pack_half_float(weights)
+
+    raw = vertices.view(np.uint8).reshape(len(vertices), dtype.itemsize)
+    if vcolor and white.any():
+        keep = np.ones(raw.shape, dtype=bool)
+        color_offset = dtype.fields["color"][1]
+        keep[white, color_offset + 1:color_offset + 4] = False
+        return raw[keep].tobytes()
+    return raw.tobytes()
+
+
+def encode_indices(indices, vertex_count):
+    """
+    Index buffer as uint8 when every index fits, otherwise as uint16
+    :param indices:
+    :param vertex_count:
+    :return: bytes
+    """
+    assert vertex_count < 65536
+    return np.asarray(indices, dtype="<u2" if vertex_count > 255 else "u1").tobytes()
+
+
+def encode_mesh_buffer(material_id, vertex_data, indices, vertex_count):
+    """
+    Mesh buffer record: vertex count, index count, material id, vertices and
+    indices
+    :param material_id:
+    :param vertex_data: bytes from encode_vertices
+    :param indices:
+    :param vertex_count:
+    :return: bytes
+    """
+    header = np.array([(vertex_count, len(indices), material_id)], dtype=[("v", "<u4"), ("i", "<u4"), ("m", "<u2")])
+    return header.tobytes() + vertex_data + encode_indices(indices, vertex_count)
+
+
+def find_redundant_attributes(job):
+    """
+    Optional vertex attributes of a material job which carry no information:
+    "color" when every corner is white, "uv_two" when the second uv set packs
+    to the same half floats as the first one. Only the vertex color flag can
+    be pruned, the second uv set has no flag
+    :param job: dict as taken by encode_material
+    :return: set of attribute names
+    """
+    redundant = set()
+    if job["vcolor"] and (np.asarray(job["color"]) == 255).all():
+        redundant.add("color")
+    if job["uv_one"] and job["uv_two"]:
+        packed = pack_half_float(job["all_uvs"])
+        if np.array_equal(packed[:, 0:2], packed[:, 2:4]):
+            redundant.add("uv_two")
+    return redundant
+
+
+def encode_material(job):
+    """
+    Weld, split, smooth tangents, optionally optimize and encode the
+    triangles of one material. Only takes and returns plain arrays, so it can
+    run in a worker process
+    :param job: dict with the material id, the (3 * triangle count, k) corner
+                arrays position, normal, color, all_uvs, tangent, joints and
+                weights, and the flags uv_one, uv_two, vcolor, write_joints,
+                export_tangent, export_normal, optimize and report_bounds
+    :return: list of (mesh buffer bytes, vertex positions), list of messages
+    """
+    position = job["position"]
+    tangent = job["tangent"]
+    joints = job["joints"] if job["write_joints"] else None
+    weights = job["weights"] if job["write_joints"] else None
+    keys = build_weld_keys(position, job["normal"], job["color"], job["all_uvs"], tangent, joints, weights)
+
+    buffers = []
+    messages = []
+    for corner_start, corner_end, vertex_corners, indices in split_buffer(keys):
+        if job["export_tangent"]:
+            tangents = average_tangents(tangent[corner_start:corner_end], indices, vertex_corners - corner_start)
+        else:
+            tangents = tangent[vertex_corners]
+
+        if job["optimize"]:
+            vertex_order, indices, stats = optimize_buffer(indices, position[vertex_corners])
+            culled, acmr_before, acmr_after = stats
+            messages.append(
+                "Mesh buffer {}: ACMR {:.3f} -> {:.3f}, {} degenerate triangle(s) removed".format(
+                    job["material_id"], acmr_before, acmr_after, culled
+                )
+            )
+            if len(indices) == 0:
+                continue
+            vertex_corners = vertex_corners[vertex_order]
+            tangents = tangents[vertex_order]
+
+        if job["report_bounds"]:
+            lower = position[vertex_corners].min(axis=0)
+            upper = position[vertex_corners].max(axis=0)
+            messages.append(
+                "Mesh buffer {}: {} vertices, bounding box {} x {} x {}, volume {:.2f}".format(
+                    job["material_id"], len(vertex_corners), *["{:.2f}".format(e) for e in (upper - lower).tolist()],
+                    float(np.prod(upper - lower, dtype=np.float64))
+                )
+            )
+
+        vertex_data = encode_vertices(
+            position[vertex_corners], job["normal"][vertex_corners], job["color"][vertex_corners],
+            job["all_uvs"][vertex_corners], tangents, job["joints"][vertex_corners], job["weights"][vertex_corners],
+            job["uv_one"], job["uv_two"], job["vcolor"], job["write_joints"], job["export_tangent"],
+            job["export_normal"]
+        )
+        data = encode_mesh_buffer(job["material_id"], vertex_data, indices, len(vertex_corners))
+        buffers.append((data, position[vertex_corners]))
+    return buffers, messages
+
+
+def select_influences(influence_vertex, influence_name, influence_weight, vertex_count, in_names, max_influences=4):
+    """
+    Strongest influences of each vertex among the selected vertex groups
+    :param influence_vertex: vertex of each influence, the influences are
+                             sorted by vertex then by decreasing weight
+    :param influence_name: vertex group name index of each influence
+    :param influence_weight:
+    :param vertex_count:
+    :param in_names: bool per vertex group name, True for the selected ones
+    :param max_influences:
+    :return: (vertex count, max_influences) name index, -1 when unused, and
+             the matching weights
+    """
+    selected = in_names[influence_name]
+    vertex = influence_vertex[selected]
+    # Position of each influence among the selected ones of its vertex
+    starts = np.flatnonzero(np.concatenate(([True], vertex[1:] != vertex[:-1])))
+    rank = np.arange(len(vertex)) - np.repeat(starts, np.diff(np.concatenate((starts, [len(vertex)]))))
+    kept = rank < max_influences
+
+    vertex_names = np.full((vertex_count, max_influences), -1, dtype=np.int64)
+    vertex_weights = np.zeros((vertex_count, max_influences), dtype=np.float64)
+    vertex_names[vertex[kept], rank[kept]] = influence_name[selected][kept]
+    vertex_weights[vertex[kept], rank[kept]] = influence_weight[selected][kept]
+    return vertex_names, vertex_weights
+
+
+def _spread_bits(values):
+    """
+    Insert two zero bits between each of the lower 21 bits of values
+    :param values: uint64 array
+    :return:
+    """
+    values = values & np.uint64(0x1fffff)
+    values = (values | values << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    values = (values | values << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    values = (values | values << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    values = (values | values << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    values = (values | values << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return values
+
+
+def morton_code(points, bits=21, lower=None, upper=None):
+    """
+    Morton (Z-order) code of points inside the cube enclosing lower / upper,
+    each axis is quantized to bits bits and the axes are interleaved
+    :param points: (n, 3)
+    :param bits: bits per axis, at most 21
+    :param lower: corner of the cube, defaults to the minimum of points
+    :param upper: defaults to the maximum of points
+    :return: (n,) uint64
+    """
+    points = np.asarray(points, dtype=np.float64)
+    lower = points.min(axis=0) if lower is None else np.asarray(lower, dtype=np.float64)
+    upper = points.max(axis=0) if upper is None else np.asarray(upper, dtype=np.float64)
+    extent = max(float((upper - lower).max()), 1e-6)
+    cells = 1 << bits
+    grid = np.clip(np.floor((points - lower) / extent * cells), 0, cells - 1).astype(np.uint64)
+    return _spread_bits(grid[:, 0]) | _spread_bits(grid[:, 1]) << np.uint64(1) | \
+        _spread_bits(grid[:, 2]) << np.uint64(2)
+
+
+def partition_grid(centroids, sector_size):
+    """
+    Put each triangle in the sector_size sized grid cell holding its centroid
+    :param centroids: (n, 3) triangle centroids
+    :param sector_size:
+    :return: (n,) dense sector id of each triangle
+    """
+    centroids = np.asarray(centroids, dtype=np.float64)
+    cells = np.floor((centroids - centroids.min(axis=0)) / sector_size).astype(np.int64)
+    _, sector = np.unique(cells, axis=0, return_inverse=True)
+    return sector.ravel()
+
+
+def partition_octree(centroids, max_triangles, max_depth=7):
+    """
+    Octree over the triangle centroids, a node is split into its 8 children
+    while it holds more than max_triangles triangles and max_depth is not
+    reached, every leaf becomes a sector
+    :param centroids: (n, 3) triangle centroids
+    :param max_triangles:
+    :param max_depth:
+    :return: (n,) dense sector id of each triangle, leaves in Z-order
+    """
+    code = morton_code(centroids, bits=max_depth)
+    leaf = np.full(len(code), -1, dtype=np.int64)
+    pending = np.arange(len(code))
+    for depth in range(0, max_depth + 1):
+        node = code[pending] >> np.uint64(3 * (max_depth - depth))
+        _, inverse, counts = np.unique(node, return_inverse=True, return_counts=True)
+        done = (counts[inverse.ravel()] <= max_triangles) | (depth == max_depth)
+        # Leaves never overlap, so the first full code of a leaf identifies it
+        leaf[pending[done]] = node[done].astype(np.int64) << 3 * (max_depth - depth)
+        pending = pending[~done]
+        if len(pending) == 0:
+            break
+    _, sector = np.unique(leaf, return_inverse=True)
+    return sector.ravel()
@@ -0,0 +1,62 @@
+#!BPY
+
+# Copyright (c) 2017 SPM author(s)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Process pool shared by the exporter and the importer. Does not depend on bpy,
+# workers are forked so they do not have to import it either.
+
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+
+# Encoding takes about 1 us per corner. Starting a pool of two forked workers
+# took 15 to 35 ms before any work was done, more when forking Blender, and
+# sending the jobs to the workers about 0.15 us per corner in this process.
+# Work with fewer corners is done in process
+MIN_PARALLEL_CORNERS = 200000
+
+
+def map_jobs(function, jobs, processes=1, corner_count=0):
+    """
+    Run function over jobs, in a pool of forked workers when asked for and the
+    jobs are large enough to pay for it, results come back in job order
+    :param function: module level function taking one job
+    :param jobs: list of picklable jobs
+    :param processes: worker count, 0 for one per core, 1 to run here
+    :param corner_count: triangle corners in all jobs, compared against
+                         MIN_PARALLEL_CORNERS
+    :return: generator of function results
+    """
+    if processes == 0:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(jobs))
+    can_fork = sys.platform != "win32" and multiprocessing.get_start_method() == "fork"
+    if processes < 2 or not can_fork or corner_count < MIN_PARALLEL_CORNERS:
+        for job in jobs:
+            yield function(job)
+        return
+
+    # Sectors of a space partitioned mesh make many small jobs, batch them
+    chunksize = max(1, len(jobs) // (processes * 4))
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        for result in executor.map(function, jobs, chunksize=chunksize):
+            yield result
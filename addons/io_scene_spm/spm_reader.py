@@ -0,0 +1,400 @@
+#!BPY
+
+# Copyright (c) 2017 SPM author(s)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Memory mapped SPM reader, the mesh buffers, index buffers and animation
+# frames are NumPy views into the file instead of copies, close the SPMFile
+# (or use it as a context manager) once done with them. Does not depend on
+# bpy so asset tools can use it outside of Blender, running
+# python3 spm_reader.py file.spm prints a summary of the file
+
+import mmap
+import os.path
+import sys
+import numpy as np
+
+try:
+    from . import spm_mesh
+except (ImportError, SystemError):
+    # Imported from the add-on directory instead of as part of the package
+    import spm_mesh
+
+SPM_VERSION = 1
+
+SPM_TYPES = ("SPMS", "SPMA", "SPMN")
+
+# Location, rotation (xyzw quaternion) and scale of a bone
+LOC_ROT_SCALE_DTYPE = np.dtype(("<f4", (10, )))
+
+
+class SPMMeshBuffer:
+    """
+    Vertices and indices of one mesh buffer. m_vertices is a structured array
+    with the fields of spm_mesh.get_vertex_dtype, it is a view into the file
+    unless the buffer mixes white and colored vertices, which are stored with
+    different sizes and get decoded into a copy with 4 byte colors
+    """
+
+    def __init__(self, material_id, vertices, indices, offset, size):
+        self.m_material_id = material_id
+        self.m_vertices = vertices
+        self.m_indices = indices
+        # Location of the whole record in the file
+        self.m_offset = offset
+        self.m_size = size
+
+    def __len__(self):
+        return len(self.m_vertices)
+
+    def has_field(self, name):
+        return name in self.m_vertices.dtype.names
+
+    def get_positions(self):
+        return self.m_vertices["position"]
+
+    def get_normals(self):
+        """
+        :return: (n, 3) float32
+        """
+        return spm_mesh.unpack_2101010_rev(self.m_vertices["normal"])[:, 0:3]
+
+    def get_colors(self):
+        """
+        :return: (n, 3) uint8, white for vertices without a stored color
+        """
+        color = self.m_vertices["color"]
+        if color.shape[1] == 1:
+            return np.full((len(color), 3), 255, dtype=np.uint8)
+        return np.where(color[:, 0:1] == 128, np.uint8(255), color[:, 1:4])
+
+    def get_uvs(self, field="uv_one"):
+        """
+        :param field: uv_one or uv_two
+        :return: (n, 2) float32 as stored, v is not flipped
+        """
+        return self.m_vertices[field].astype(np.float32)
+
+    def get_tangents(self):
+        """
+        :return: (n, 4) float32 tangent and bitangent sign
+        """
+        return spm_mesh.unpack_2101010_rev(self.m_vertices["tangent"])
+
+    def get_triangles(self):
+        return self.m_indices.reshape(-1, 3)
+
+    def get_blender_arrays(self, weld=False):
+        """
+        Mesh data laid out the way Blender takes it: y and z swapped, triangles
+        wound the other way, v flipped and uvs and colors per loop
+        :param weld: merge vertices closer than 1 / WELD_PRECISION like
+                     bmesh.ops.remove_doubles
+        :return: dict of float32 arrays, vertices (n, 3), uv_one and uv_two
+                 (loop count, 2), color (loop count, 3) when the buffer has
+                 them, and int32 loops, the vertex of each loop
+        """
+        vertices = self.get_positions()[:, [0, 2, 1]]
+        corners = self.get_triangles()[:, ::-1].ravel()
+        loops = corners
+        if weld:
+            first, remap = spm_mesh.weld(spm_mesh.quantize(vertices))
+            vertices = vertices[first]
+            loops = remap[corners]
+
+        ret = {"vertices": np.ascontiguousarray(vertices, dtype=np.float32), "loops": loops.astype(np.int32)}
+        for field in ("uv_one", "uv_two"):
+            if self.has_field(field):
+                uv = self.get_uvs(field)[corners]
+                uv[:, 1] = 1.0 - uv[:, 1]
+                ret[field] = uv
+        if self.has_field("color"):
+            ret["color"] = self.get_colors()[corners].astype(np.float32) / 255.0
+        return ret
+
+
+class SPMSector:
+
+    def __init__(self, mesh_buffers, bounding_box=None):
+        self.m_mesh_buffers = mesh_buffers
+        # (2, 3) lower and upper corner, only stored in SPMS files
+        self.m_bounding_box = bounding_box
+
+
+class SPMArmature:
+    """
+    Bones and keyframes of one armature, m_bind_locRotScale and
+    m_frames["locRotScale"] are (bone count, 10) views per bone in local id
+    order. Frames are stored 0 based, one less than the Blender frame
+    """
+
+    def __init__(self, bone_in_use, bone_names, bind_locRotScale, parents, frames):
+        self.m_bone_in_use = bone_in_use
+        self.m_bone_names = bone_names
+        self.m_bind_locRotScale = bind_locRotScale
+        self.m_parents = parents
+        # Structured array of frame and locRotScale of every bone
+        self.m_frames = frames
+
+
+class SPMFile:
+    """
+    Parses the whole structure of an SPM file on construction, raises
+    ValueError for files it cannot read. The arrays it returns are views of
+    the mapped file, copy what must outlive close()
+    """
+
+    def __init__(self, filename):
+        self.m_filename = filename
+        with open(filename, "rb") as f:
+            self.m_mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.m_data = np.frombuffer(self.m_mmap, dtype=np.uint8)
+        self.m_offset = 0
+        self.m_sectors = []
+        self.m_armatures = []
+        try:
+            self.read_file()
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Drop the views of the file and unmap it. A view still held by the
+        caller keeps the mapping alive until it is freed instead
+        :return:
+        """
+        self.m_sectors = []
+        self.m_armatures = []
+        self.m_bounding_box = None
+        self.m_data = None
+        try:
+            self.m_mmap.close()
+        except BufferError:
+            pass
+
+    def read_file(self):
+        """
+        Walk the header, the sectors and the armatures from the start of the file
+        :return:
+        """
+        filename = self.m_filename
+        if self.read_bytes(2) != b"SP":
+            raise ValueError("%s is not a valid spm file" % filename)
+        byte = self.read_scalar("u1")
+        self.m_version = byte >> 3
+        if self.m_version != SPM_VERSION:
+            raise ValueError("%d unsupported version" % self.m_version)
+        self.m_type = SPM_TYPES[min(byte & 0x07, 2)]
+
+        byte = self.read_scalar("u1")
+        self.m_normal = bool(byte & 0x01)
+        self.m_vcolor = bool(byte >> 1 & 0x01)
+        self.m_tangent = bool(byte >> 2 & 0x01)
+        self.m_bounding_box = self.read_array("<f4", 6).reshape(2, 3)
+
+        self.m_materials = []
+        for material in range(0, self.read_scalar("<u2")):
+            self.m_materials.append((self.read_len_string(), self.read_len_string()))
+
+        self.m_sectors = []
+        for sector in range(0, self.read_scalar("<u2")):
+            mesh_buffers = [self.read_mesh_buffer() for mesh_buffer in range(0, self.read_scalar("<u2"))]
+            bounding_box = None
+            if self.m_type == "SPMS":
+                bounding_box = self.read_array("<f4", 6).reshape(2, 3)
+            self.m_sectors.append(SPMSector(mesh_buffers, bounding_box))
+
+        if self.m_type == "SPMS" and self.m_offset + 2 <= len(self.m_data):
+            # Reserved for pre-computed visible sectors
+            self.read_scalar("<u2")
+
+        self.m_static_frame = None
+        self.m_armatures = []
+        if self.m_type == "SPMA":
+            armature_count = self.read_scalar("u1")
+            self.m_static_frame = self.read_scalar("<u2") + 1
+            for armature in range(0, armature_count):
+                self.m_armatures.append(self.read_armature())
+
+    def check_size(self, size):
+        if self.m_offset + size > len(self.m_data):
+            raise ValueError("%s is truncated at offset %d" % (self.m_filename, self.m_offset))
+
+    def read_array(self, dtype, count):
+        """
+        View of count elements at the current offset, the offset is advanced
+        past them
+        :param dtype:
+        :param count:
+        :return: read only ndarray sharing memory with the file
+        """
+        dtype = np.dtype(dtype)
+        self.check_size(dtype.itemsize * count)
+        ret = np.ndarray((count, ), dtype=dtype, buffer=self.m_data, offset=self.m_offset)
+        self.m_offset += dtype.itemsize * count
+        return ret
+
+    def read_scalar(self, dtype):
+        return self.read_array(dtype, 1)[0].item()
+
+    def read_bytes(self, size):
+        self.check_size(size)
+        ret = self.m_data[self.m_offset:self.m_offset + size].tobytes()
+        self.m_offset += size
+        return ret
+
+    def read_len_string(self):
+        return self.read_bytes(self.read_scalar("u1")).decode("ascii")
+
+    def read_mesh_buffer(self):
+        offset = self.m_offset
+        vertex_count = self.read_scalar("<u4")
+        index_count = self.read_scalar("<u4")
+        material_id = self.read_scalar("<u2")
+        if material_id >= len(self.m_materials):
+            raise ValueError("%s has a mesh buffer with an invalid material %d" % (self.m_filename, material_id))
+
+        texture_one, texture_two = self.m_materials[material_id]
+        flags = (
+            self.m_normal, self.m_vcolor, texture_one != "", texture_two != "", self.m_tangent, self.m_type == "SPMA"
+        )
+        if self.m_vcolor:
+            vertices = self.read_colored_vertices(flags, vertex_count)
+        else:
+            vertices = self.read_array(spm_mesh.get_vertex_dtype(*flags), vertex_count)
+
+        index_dtype = "<u4" if vertex_count > 65535 else "<u2" if vertex_count > 255 else "u1"
+        indices = self.read_array(index_dtype, index_count)
+        return SPMMeshBuffer(material_id, vertices, indices, offset, self.m_offset - offset)
+
+    def read_colored_vertices(self, flags, vertex_count):
+        """
+        Vertices whose color takes 1 byte when white (identifier 128) and 4
+        bytes otherwise. Buffers with only one kind are viewed in place, mixed
+        buffers are walked vertex by vertex and gathered into a copy
+        :param flags: arguments of spm_mesh.get_vertex_dtype
+        :param vertex_count:
+        :return: structured array
+        """
+        start = self.m_offset
+        for color_size in (1, 4):
+            dtype = spm_mesh.get_vertex_dtype(*flags, color_size=color_size)
+            if start + dtype.itemsize * vertex_count > len(self.m_data):
+                continue
+            identifier_offsets = np.arange(vertex_count, dtype=np.int64) * dtype.itemsize
+            identifiers = self.m_data[start + dtype.fields["color"][1] + identifier_offsets]
+            if (identifiers == 128).all() if color_size == 1 else (identifiers != 128).all():
+                return self.read_array(dtype, vertex_count)
+
+        dtype = spm_mesh.get_vertex_dtype(*flags)
+        stride = dtype.itemsize
+        color_offset = dtype.fields["color"][1]
+        data = self.m_data[start:start + vertex_count * stride].tobytes()
+        offsets = np.empty(vertex_count, dtype=np.int64)
+        offset = 0
+        for i in range(0, vertex_count):
+            offsets[i] = offset
+            offset += stride - 3 if data[offset + color_offset] == 128 else stride
+        self.check_size(offset)
+
+        # Gather each vertex into a full size record, white vertices skip the
+        # 3 color bytes they do not have
+        white = np.frombuffer(data, dtype=np.uint8)[offsets + color_offset] == 128
+        gather = start + offsets[:, None] + np.arange(stride, dtype=np.int64)
+        gather[white, color_offset + 1:color_offset + 4] = gather[white, color_offset:color_offset + 1]
+        gather[white, color_offset + 4:] -= 3
+        raw = self.m_data[gather]
+        raw[white, color_offset + 1:color_offset + 4] = 255
+        self.m_offset += offset
+        return np.ascontiguousarray(raw).view(dtype).ravel()
+
+    def read_armature(self):
+        bone_in_use = self.read_scalar("<u2")
+        bone_count = self.read_scalar("<u2")
+        bone_names = [self.read_len_string() for bone in range(0, bone_count)]
+        bind_locRotScale = self.read_array(LOC_ROT_SCALE_DTYPE, bone_count)
+        parents = self.read_array("<i2", bone_count)
+        frame_dtype = np.dtype([("frame", "<u2"), ("locRotScale", LOC_ROT_SCALE_DTYPE, (bone_count, ))])
+        frames = self.read_array(frame_dtype, self.read_scalar("<u2"))
+        return SPMArmature(bone_in_use, bone_names, bind_locRotScale, parents, frames)
+
+    def get_mesh_buffers(self):
+        """
+        :return: mesh buffers of all sectors in file order
+        """
+        return [mesh_buffer for sector in self.m_sectors for mesh_buffer in sector.m_mesh_buffers]
+
+
+def decode_file(job):
+    """
+    Parse a file and decode all of its mesh buffers for the importer, only
+    takes and returns plain data so it can run in a worker process
+    :param job: (filename, weld)
+    :return: dict with the materials, a list of (material id, arrays from
+             get_blender_arrays) mesh buffers and the error message of an
+             unreadable file or None
+    """
+    filename, weld = job
+    try:
+        # get_blender_arrays returns copies, nothing refers to the mapping
+        # once the file is closed
+        with SPMFile(filename) as spm:
+            materials = spm.m_materials
+            mesh_buffers = [
+                (mesh_buffer.m_material_id, mesh_buffer.get_blender_arrays(weld))
+                for mesh_buffer in spm.get_mesh_buffers()
+            ]
+    except (OSError, ValueError) as e:
+        return {"materials": [], "mesh_buffers": [], "error": str(e)}
+    return {"materials": materials, "mesh_buffers": mesh_buffers, "error": None}
+
+
+def print_summary(spm):
+    print(
+        "%s: %s, normal %d, vertex color %d, tangent %d" %
+        (os.path.basename(spm.m_filename), spm.m_type, spm.m_normal, spm.m_vcolor, spm.m_tangent)
+    )
+    print("  %d material(s), %d sector(s)" % (len(spm.m_materials), len(spm.m_sectors)))
+    for mesh_buffer in spm.get_mesh_buffers():
+        print(
+            "  mesh buffer %d: %d vertices, %d triangles, %d bytes, %s" % (
+                mesh_buffer.m_material_id, len(mesh_buffer), len(mesh_buffer.m_indices) // 3, mesh_buffer.m_size,
+                ";".join(name for name in spm.m_materials[mesh_buffer.m_material_id] if name)
+            )
+        )
+    for armature in spm.m_armatures:
+        print(
+            "  armature: %d bone(s), %d in use, %d frame(s)" %
+            (len(armature.m_bone_names), armature.m_bone_in_use, len(armature.m_frames))
+        )
+
+
+if __name__ == "__main__":
+    for filename in sys.argv[1:]:
+        with SPMFile(filename) as spm:
+            print_summary(spm)
@@ -0,0 +1,150 @@
+#!BPY
+
+# Copyright (c) 2017 SPM author(s)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Streaming writer for the SPM file layout around the mesh buffers encoded by
+# spm_mesh. Does not depend on bpy, the exporter feeds it.
+
+import os
+import struct
+import numpy as np
+
+
+def grow_bounding_box(box, positions):
+    """
+    :param box: min xyz and max xyz, or None for an empty box
+    :param positions: (n, 3)
+    :return: the grown box
+    """
+    grown = np.concatenate([positions.min(axis=0), positions.max(axis=0)]).astype(np.float64)
+    if box is not None:
+        grown[0:3] = np.minimum(box[0:3], grown[0:3])
+        grown[3:6] = np.maximum(box[3:6], grown[3:6])
+    return grown
+
+
+def pack_bounding_box(box):
+    """
+    :param box: min xyz and max xyz, or None for an empty box
+    :return: 24 bytes, all zero for an empty box
+    """
+    if box is None:
+        return bytes(24)
+    return np.asarray(box, dtype="<f4").tobytes()
+
+
+class SPMWriter:
+    """
+    Streams an SPM file to disk as it is produced instead of building it in
+    memory. The bounding box and mesh buffer count are only known at the end,
+    they are reserved in the header and patched in by close(). The file is
+    written under a temporary name and renamed over filename once complete,
+    use as a context manager so a failed export leaves no partial file.
+    """
+
+    def __init__(self, filename):
+        self.m_filename = filename
+        self.m_temp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        self.m_file = open(self.m_temp_filename, 'wb')
+        self.m_bounding_box = None
+        self.m_bounding_box_offset = None
+        self.m_mesh_buffer_count = 0
+        self.m_mesh_buffer_count_offset = None
+        self.m_sector_bounding_box = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def write(self, data):
+        self.m_file.write(data)
+
+    def reserve(self, size):
+        """
+        Write size zero bytes to be patched later
+        :param size:
+        :return: offset of the reserved bytes
+        """
+        offset = self.m_file.tell()
+        self.m_file.write(bytes(size))
+        return offset
+
+    def patch(self, offset, data):
+        end = self.m_file.tell()
+        self.m_file.seek(offset)
+        self.m_file.write(data)
+        self.m_file.seek(end)
+
+    def write_header(self, type_byte, flags_byte):
+        # SP header
+        self.write(struct.pack("<HBB", 20563, type_byte, flags_byte))
+        self.m_bounding_box_offset = self.reserve(24)
+
+    def write_materials(self, texture_list):
+        self.write(struct.pack("<H", len(texture_list) >> 1))
+        for texture_name in texture_list:
+            encoded = str.encode(texture_name)[0:255]
+            self.write(struct.pack("<B", len(encoded)) + encoded)
+
+    def begin_mesh_buffers(self):
+        self.m_mesh_buffer_count_offset = self.reserve(2)
+        self.m_mesh_buffer_count = 0
+        self.m_sector_bounding_box = None
+
+    def write_mesh_buffer(self, data, positions):
+        """
+        Write one encoded mesh buffer and grow the bounding boxes by its vertices
+        :param data: bytes from spm_mesh.encode_mesh_buffer
+        :param positions: (n, 3) vertex positions of the buffer
+        :return:
+        """
+        self.write(data)
+        self.m_mesh_buffer_count += 1
+        self.m_bounding_box = grow_bounding_box(self.m_bounding_box, positions)
+        self.m_sector_bounding_box = grow_bounding_box(self.m_sector_bounding_box, positions)
+
+    def end_mesh_buffers(self, write_bounding_box=False):
+        """
+        Patch the mesh buffer count of the current sector
+        :param write_bounding_box: append the sector bounding box, used by
+                                   SPMS. A sector left without mesh buffers,
+                                   when optimizing culled all of its
+                                   triangles, gets an all zero box
+        :return:
+        """
+        self.patch(self.m_mesh_buffer_count_offset, struct.pack("<H", self.m_mesh_buffer_count))
+        if write_bounding_box:
+            self.write(pack_bounding_box(self.m_sector_bounding_box))
+
+    def close(self):
+        self.patch(self.m_bounding_box_offset, pack_bounding_box(self.m_bounding_box))
+        self.m_file.close()
+        os.replace(self.m_temp_filename, self.m_filename)
+
+    def abort(self):
+        self.m_file.close()
+        os.remove(self.m_temp_filename)
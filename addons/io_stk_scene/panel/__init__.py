@@ -533,6 +533,17 @@ class StkPanelAddonPreferences(AddonPreferences):
     # subtype='DIR_PATH',
     )
 
+    stk_spm_cache_path = StringProperty(
+        name="Folder caching exported models between track exports (empty to disable)",
+        subtype='DIR_PATH',
+    )
+
+    stk_spm_cache_size = IntProperty(
+        name="Model cache size (MB, 0 to disable)",
+        default=512,
+        min=0,
+    )
+
     def draw(self, context):
         layout = self.layout
         layout.label(
@@ -542,6 +553,8 @@ class StkPanelAddonPreferences(AddonPreferences):
         layout.prop(self, "stk_assets_path")
 
         layout.prop(self, "stk_delete_old_files_on_export")
+        layout.prop(self, "stk_spm_cache_path")
+        layout.prop(self, "stk_spm_cache_size")
 
 
 # class STK_AddLightmap(bpy.types.Operator):
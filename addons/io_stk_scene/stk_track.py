@@ -301,11 +301,92 @@ def getSceneProperty(scene, name, default="", set_value_if_undefined=1):
     return default
 
 
+# ------------------------------------------------------------------------------
+# Defaults of the BoolProps of stk_panel_parameters.xml by id, parsed once per
+# session
+
+panel_bool_defaults = None
+
+
+def getPanelBoolDefaults():
+    global panel_bool_defaults
+    if panel_bool_defaults is None:
+        import xml.dom.minidom
+        path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data", "stk_panel_parameters.xml")
+        panel_bool_defaults = {}
+        for node in xml.dom.minidom.parse(path).getElementsByTagName("BoolProp"):
+            panel_bool_defaults[node.getAttribute("id")] = (node.getAttribute("default") == "true")
+    return panel_bool_defaults
+
+
+# ------------------------------------------------------------------------------
+# The panel writes "true" and "false", older files may use "Y", "N", "yes"...
+
+
+def parseBoolProperty(value):
+    if isinstance(value, str):
+        return len(value) > 0 and value[0] not in "nNfF0"
+    return bool(value)
+
+
+# ------------------------------------------------------------------------------
+# Scene flags the exporters branch on, read once per export and passed to the
+# exporters instead of being looked up and parsed again on every use. Each
+# flag must be a BoolProp of stk_panel_parameters.xml, which also gives its
+# default. Unlike getSceneProperty, missing flags are not written to the scene.
+
+
+class TrackSettings:
+
+    def __init__(self, scene):
+        self.m_is_stk_track = self.readFlag(scene, "is_stk_track")
+        self.m_is_stk_node = self.readFlag(scene, "is_stk_node")
+        self.m_is_arena = self.readFlag(scene, "arena")
+        self.m_is_soccer = self.readFlag(scene, "soccer")
+        self.m_is_cutscene = self.readFlag(scene, "cutscene")
+
+    def readFlag(self, scene, name):
+        defaults = getPanelBoolDefaults()
+        if name not in defaults:
+            raise Exception("(STK) %s is not a BoolProp of stk_panel_parameters.xml" % name)
+        if name in scene:
+            return parseBoolProperty(scene[name])
+        return defaults[name]
+
+    # Arenas and soccer fields have a navmesh instead of drivelines
+    def hasNavmesh(self):
+        return self.m_is_arena or self.m_is_soccer
+
+
+# ------------------------------------------------------------------------------
+# Snapshot of the custom properties of every object, taken once per export by
+# TrackExport so that getObjectProperty is a dict lookup instead of a proxy
+# check and an exception for every missing property. The properties of the
+# proxy override the ones of the object, like getObjectProperty does.
+
+the_object_properties = None
+
+
+def snapshotObjectProperties(objects):
+    snapshot = {}
+    for obj in objects:
+        properties = dict(obj.items())
+        if obj.proxy is not None:
+            properties.update(obj.proxy.items())
+        snapshot[obj] = properties
+    return snapshot
+
+
 # ------------------------------------------------------------------------------
 # Gets a custom property of an object
 
 
 def getObjectProperty(obj, name, default=""):
+    if the_object_properties is not None:
+        properties = the_object_properties.get(obj)
+        if properties is not None:
+            return properties.get(name, default)
+
     if obj.proxy is not None:
         try:
             return obj.proxy[name]
@@ -318,6 +399,23 @@ def getObjectProperty(obj, name, default=""):
         return default
 
 
+# ------------------------------------------------------------------------------
+# Gets the 0 based frames of the "start" and "end" timeline markers between
+# first_frame and last_frame (inclusive) in one pass over the markers, sorted
+# like a scan of every frame would find them.
+
+
+def getMarkerFrames(scene, first_frame, last_frame):
+    frames = {"start": [], "end": []}
+    for curr in scene.timeline_markers:
+        marker_name = curr.name.lower()
+        if marker_name in frames and first_frame <= curr.frame <= last_frame:
+            frames[marker_name].append(curr.frame - 1)
+    for marker_frames in frames.values():
+        marker_frames.sort()
+    return frames
+
+
 # ------------------------------------------------------------------------------
 # FIXME: should use xyz="..." format
 # Returns a string 'x="1" y="2" z="3" h="4"', where 1, 2, ...are the actual
@@ -737,7 +835,8 @@ class ActionTriggerExporter:
 # ------------------------------------------------------------------------------
 class StartPositionExporter:
 
-    def __init__(self):
+    def __init__(self, settings):
+        self.m_settings = settings
         self.m_objects = []
 
     def processObject(self, object, stktype):
@@ -754,7 +853,7 @@ class StartPositionExporter:
         distance_forwards = float(getSceneProperty(scene, "start_forwards_distance", 1.5))
         distance_sidewards = float(getSceneProperty(scene, "start_sidewards_distance", 3.0))
         distance_upwards = float(getSceneProperty(scene, "start_upwards_distance", 0.1))
-        if getSceneProperty(bpy.data.scenes[0], 'is_stk_node', 'false') != 'true':
+        if not self.m_settings.m_is_stk_node:
             f.write("  <default-start karts-per-row     =\"%i\"\n" % karts_per_row)
             f.write("                 forwards-distance =\"%.2f\"\n" % distance_forwards)
             f.write("                 sidewards-distance=\"%.2f\"\n" % distance_sidewards)
@@ -771,7 +870,7 @@ class StartPositionExporter:
 
         l = dId2Obj.keys()
 
-        if len(l) < 4 and getSceneProperty(scene, "arena", "false") == "true":
+        if len(l) < 4 and self.m_settings.m_is_arena:
             log_warning("You should define at least 4 start positions")
 
         for key, value in sorted(dId2Obj.items()):
@@ -959,15 +1058,14 @@ class LightShaftExporter:
 
 class NavmeshExporter:
 
-    def __init__(self):
+    def __init__(self, settings):
+        self.m_settings = settings
         self.m_objects = []
 
     def processObject(self, object, stktype):
 
         if stktype == "NAVMESH":
-            is_arena = getSceneProperty(bpy.data.scenes[0], "arena", "false") == "true"
-            is_soccer = getSceneProperty(bpy.data.scenes[0], "soccer", "false") == "true"
-            if (is_arena or is_soccer):
+            if self.m_settings.hasNavmesh():
                 self.m_objects.append(object)
             else:
                 log_warning("Navmesh may only be used in battle arenas or soccer field")
@@ -1049,7 +1147,8 @@ class NavmeshExporter:
 
 class DrivelineExporter:
 
-    def __init__(self):
+    def __init__(self, settings):
+        self.m_settings = settings
         self.lChecks = []
         self.lCannons = []
         self.lDrivelines = []
@@ -1082,21 +1181,18 @@ class DrivelineExporter:
         return False
 
     def export(self, f):
-        is_arena = getSceneProperty(bpy.data.scenes[0], "arena", "false") == "true"
-        is_soccer = getSceneProperty(bpy.data.scenes[0], "soccer", "false") == "true"
-        is_cutscene = getSceneProperty(bpy.data.scenes[0], "cutscene", "false") == "true"
-        if not self.found_main_driveline and not is_arena and not is_soccer and not is_cutscene:
+        settings = self.m_settings
+        if not self.found_main_driveline and not settings.hasNavmesh() and not settings.m_is_cutscene:
             if len(self.lDrivelines) > 0:
                 log_warning("Main driveline missing, using first driveline as main!")
-            elif getSceneProperty(bpy.data.scenes[0], 'is_stk_node', 'false') != 'true':
+            elif not settings.m_is_stk_node:
                 log_error("No driveline found")
 
         if len(self.lDrivelines) == 0:
             self.lDrivelines = [None]
 
         mainDriveline = self.lDrivelines[0]
-        if mainDriveline is None and getSceneProperty(bpy.data.scenes[0], 'is_stk_node', 'false'
-                                                      ) != 'true' and not (is_arena or is_soccer):
+        if mainDriveline is None and not settings.m_is_stk_node and not settings.hasNavmesh():
             log_error("No main driveline found")
 
         self.lChecks = self.lChecks + self.lCannons    # cannons at the end, see #1386
@@ -2198,7 +2294,10 @@ class TrackExport:
             filepath=sPath + "/" + name,
             export_tangent=False,
             overwrite_without_asking=True,
-            applymodifiers=applymodifiers
+            applymodifiers=applymodifiers,
+            prune_attributes=True,
+            cache_dir=self.spm_cache_dir,
+            cache_size=self.spm_cache_size
         )
         the_scene.obj_list = []
         #bpy.ops.screen.spm_export.skip_dialog = False
@@ -2223,17 +2322,9 @@ class TrackExport:
         if 'is_wip_track' in the_scene and the_scene['is_wip_track'] == 'true':
             groups = 'wip-track'
 
-        is_arena = getSceneProperty(scene, "arena", "n")
-        if not is_arena:
-            is_arena = "n"
-        is_arena = not (is_arena[0] == "n" or is_arena[0] == "N" or is_arena[0] == "f" or is_arena[0] == "F")
-
-        is_soccer = getSceneProperty(scene, "soccer", "n")
-        if not is_soccer:
-            is_soccer = "n"
-        is_soccer = not (is_soccer[0] == "n" or is_soccer[0] == "N" or is_soccer[0] == "f" or is_soccer[0] == "F")
-
-        is_cutscene = getSceneProperty(scene, "cutscene", "false") == "true"
+        is_arena = self.track_settings.m_is_arena
+        is_soccer = self.track_settings.m_is_soccer
+        is_cutscene = self.track_settings.m_is_cutscene
         is_internal = getSceneProperty(scene, "internal", "n")
         is_internal = (is_internal == "true")
         if is_cutscene:
@@ -2392,18 +2483,9 @@ class TrackExport:
 
         # For now: armature animations are assumed to be looped
         if parent and parent.type == "ARMATURE":
-            first_frame = the_scene.frame_start
-            last_frame = the_scene.frame_end
-            frame_start = []
-            frame_end = []
-            for i in range(first_frame, last_frame + 1):
-                for curr in the_scene.timeline_markers:
-                    if curr.frame == i:
-                        marker_name = curr.name.lower()
-                        if marker_name == "start":
-                            frame_start.append(i - 1)
-                        if marker_name == "end":
-                            frame_end.append(i - 1)
+            marker_frames = getMarkerFrames(the_scene, the_scene.frame_start, the_scene.frame_end)
+            frame_start = marker_frames["start"]
+            frame_end = marker_frames["end"]
             if len(frame_start) > 0 and len(frame_end) > 0:
                 flags.append('frame-start="%s"' % ' '.join(str(x) for x in frame_start))
                 flags.append('frame-end="%s"' % ' '.join(str(x) for x in frame_end))
@@ -2813,7 +2895,7 @@ class TrackExport:
         #start_time = bsys.time()
         print("Writing scene file --> \t")
 
-        is_lib_node = (getSceneProperty(bpy.data.scenes[0], 'is_stk_node', 'false') == 'true')
+        is_lib_node = self.track_settings.m_is_stk_node
 
         filename = "scene.xml"
         if is_lib_node:
@@ -2974,7 +3056,7 @@ class TrackExport:
         #        f.write('   </group>\n')
         #    f.write('  </instancing>\n')
 
-        if getSceneProperty(bpy.data.scenes[0], 'is_stk_node', 'false') != 'true':
+        if not is_lib_node:
             if lStaticObjects or lAnimTextures:
                 f.write("  <track model=\"%s\" x=\"0\" y=\"0\" z=\"0\">\n" % sTrackName)
                 self.writeStaticObjects(f, sPath, lStaticObjects, lAnimTextures)
@@ -3152,6 +3234,17 @@ class TrackExport:
         # print bsys.time()-start_time,"seconds"
 
     def __init__(self, sFilename, exportImages, exportDrivelines, exportScene, exportMaterials):
+        # Objects are not modified during the export, their custom properties
+        # are read once up front
+        global the_object_properties
+        the_object_properties = snapshotObjectProperties(bpy.data.objects)
+        self.track_settings = TrackSettings(the_scene)
+        try:
+            self.exportTrack(sFilename, exportImages, exportDrivelines, exportScene, exportMaterials)
+        finally:
+            the_object_properties = None
+
+    def exportTrack(self, sFilename, exportImages, exportDrivelines, exportScene, exportMaterials):
         self.dExportedObjects = {}
 
         sBase = os.path.basename(sFilename)
@@ -3165,6 +3258,19 @@ class TrackExport:
         except:
             pass
 
+        # Exported models are cached by content when a cache folder is set in
+        # the preferences, so unchanged objects are not encoded again on the
+        # next export
+        self.spm_cache_dir = ""
+        self.spm_cache_size = 512
+        try:
+            preferences = bpy.context.user_preferences.addons['stk_track'].preferences
+            if preferences.stk_spm_cache_path:
+                self.spm_cache_dir = bpy.path.abspath(preferences.stk_spm_cache_path)
+            self.spm_cache_size = preferences.stk_spm_cache_size
+        except:
+            pass
+
         if stk_delete_old_files_on_export:
             os.chdir(sPath)
             old_model_files = [f for f in os.listdir(sPath) if f.endswith(".spm")]
@@ -3190,8 +3296,9 @@ class TrackExport:
                     traceback.print_exc(file=sys.stdout)
                     log_warning('Failed to copy texture ' + curr.filepath)
 
-        drivelineExporter = DrivelineExporter()
-        navmeshExporter = NavmeshExporter()
+        settings = self.track_settings
+        drivelineExporter = DrivelineExporter(settings)
+        navmeshExporter = NavmeshExporter(settings)
         exporters = [
             drivelineExporter,
             WaterExporter(self, sPath),
@@ -3203,7 +3310,7 @@ class TrackExport:
             BillboardExporter(),
             LightsExporter(),
             LightShaftExporter(),
-            StartPositionExporter(),
+            StartPositionExporter(settings),
             LibraryNodeExporter(), navmeshExporter
         ]
 
@@ -3268,13 +3375,9 @@ class TrackExport:
                     log_warning("object " + obj.name + " has type property '%s', which is not supported.\n" % s)
                 lTrack.append(obj)
 
-        is_arena = getSceneProperty(bpy.data.scenes[0], "arena", "false") == "true"
-        is_soccer = getSceneProperty(bpy.data.scenes[0], "soccer", "false") == "true"
-        is_cutscene = getSceneProperty(bpy.data.scenes[0], "cutscene", "false") == "true"
-
         # Now export the different parts: track file
         # ------------------------------------------
-        if exportScene and getSceneProperty(bpy.data.scenes[0], 'is_stk_node', 'false') != 'true':
+        if exportScene and not settings.m_is_stk_node:
             self.writeTrackFile(sPath, sBase)
 
         # Quads and mapping files
@@ -3282,19 +3385,10 @@ class TrackExport:
         global the_scene
         scene = the_scene
 
-        is_arena = getSceneProperty(scene, "arena", "n")
-        if not is_arena:
-            is_arena = "n"
-        is_arena = not (is_arena[0] == "n" or is_arena[0] == "N" or is_arena[0] == "f" or is_arena[0] == "F")
-
-        is_soccer = getSceneProperty(scene, "soccer", "n")
-        if not is_soccer:
-            is_soccer = "n"
-        is_soccer = not (is_soccer[0] == "n" or is_soccer[0] == "N" or is_soccer[0] == "f" or is_soccer[0] == "F")
-
-        if exportDrivelines and not is_arena and not is_soccer and not is_cutscene:
+        if exportDrivelines and not settings.m_is_stk_node and not settings.hasNavmesh() and \
+                not settings.m_is_cutscene:
             drivelineExporter.writeQuadAndGraph(sPath)
-        if (is_arena or is_soccer):
+        if settings.hasNavmesh():
             navmeshExporter.exportNavmesh(sPath)
 
         #start_time = bsys.time()
@@ -3309,13 +3403,16 @@ class TrackExport:
             log_error("Cannot find the SPM exporter, make sure you installed it properly")
             return
 
-        if exportScene and getSceneProperty(bpy.data.scenes[0], 'is_stk_node', 'false') != 'true':
+        if exportScene and not settings.m_is_stk_node:
             bpy.ops.screen.spm_export(
                 localsp=False,
                 filepath=sPath + "/" + sTrackName,
                 do_sp=False,
                 export_tangent=False,
-                overwrite_without_asking=True
+                overwrite_without_asking=True,
+                prune_attributes=True,
+                cache_dir=self.spm_cache_dir,
+                cache_size=self.spm_cache_size
             )
         scene.obj_list = []
 
@@ -3329,7 +3426,7 @@ class TrackExport:
         if exportScene:
             self.writeSceneFile(sPath, sTrackName, exporters, lTrack, lObjects, lSun)
 
-            if len(lEasterEggs) > 0 and getSceneProperty(scene, 'is_stk_node', 'false') != 'true':
+            if len(lEasterEggs) > 0 and not settings.m_is_stk_node:
                 self.writeEasterEggsFile(sPath, lEasterEggs)
 
         # materials file
@@ -3352,10 +3449,7 @@ def savescene_callback(sFilename, exportImages, exportDrivelines, exportScene, e
     global log
     log = []
 
-    TrackExport(
-        sFilename, exportImages, exportDrivelines and
-        getSceneProperty(bpy.data.scenes[0], 'is_stk_node', 'false') != 'true', exportScene, exportMaterials
-    )
+    TrackExport(sFilename, exportImages, exportDrivelines, exportScene, exportMaterials)
 
 
 thelist = []
@@ -3388,8 +3482,9 @@ class STK_Track_Export_Operator(bpy.types.Operator):
             log_error("You must be in object mode")
             return {'FINISHED'}
 
-        isATrack = ('is_stk_track' in context.scene) and (context.scene['is_stk_track'] == 'true')
-        isANode = ('is_stk_node' in context.scene) and (context.scene['is_stk_node'] == 'true')
+        settings = TrackSettings(context.scene)
+        isATrack = settings.m_is_stk_track
+        isANode = settings.m_is_stk_node
 
         if not isATrack and not isANode:
             log_error("Not a STK library node or a track!")
@@ -3455,8 +3550,9 @@ class STK_Track_Export_Operator(bpy.types.Operator):
             self.report({'ERROR'}, "You must be in object mode")
             return {'FINISHED'}
 
-        isNotATrack = ('is_stk_track' not in context.scene) or (context.scene['is_stk_track'] != 'true')
-        isNotANode = ('is_stk_node' not in context.scene) or (context.scene['is_stk_node'] != 'true')
+        settings = TrackSettings(context.scene)
+        isNotATrack = not settings.m_is_stk_track
+        isNotANode = not settings.m_is_stk_node
 
         if self.filepath == "" or (isNotATrack and isNotANode):
             return {'FINISHED'}
@@ -3529,7 +3625,7 @@ class STK_Track_Exporter_Panel(bpy.types.Panel):
         global the_scene
         the_scene = context.scene
 
-        isNotANode = ('is_stk_node' not in context.scene) or (context.scene['is_stk_node'] != 'true')
+        isNotANode = not TrackSettings(context.scene).m_is_stk_node
         if isNotANode:
             self.bl_label = "Track Exporter"
         else:
@@ -0,0 +1,6 @@
+import os.path
+import sys
+
+# The bpy free modules of the SPM addon are imported directly, without
+# Blender
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "addons", "io_scene_spm"))
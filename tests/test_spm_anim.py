@@ -0,0 +1,58 @@
+import numpy as np
+
+import spm_anim
+
+
+def make_locRotScale(locations):
+    """
+    Identity rotation and unit scale around the given (frames, bones, 3)
+    locations
+    """
+    lrs = np.zeros(locations.shape[0:2] + (10, ), dtype=np.float64)
+    lrs[..., 0:3] = locations
+    lrs[..., 6] = 1.0
+    lrs[..., 7:10] = 1.0
+    return lrs
+
+
+def reconstruct(frames, lrs, kept):
+    reconstructed = lrs.copy()
+    for start, end in zip(kept[:-1], kept[1:]):
+        for row in range(start + 1, end):
+            t = (frames[row] - frames[start]) / (frames[end] - frames[start])
+            reconstructed[row] = spm_anim.interpolate_locRotScale(lrs[start], lrs[end], np.full(lrs.shape[1], t))
+    return reconstructed
+
+
+def test_piecewise_linear_keeps_the_knots():
+    frames = np.arange(1, 202)
+    knots = [0, 50, 120, 200]
+    heights = [0.0, 5.0, -3.0, 4.0]
+    location = np.interp(np.arange(len(frames)), knots, heights)
+    locations = np.stack([location, 2.0 * location, np.zeros_like(location)], axis=-1)[:, None, :]
+    lrs = make_locRotScale(np.repeat(locations, 3, axis=1))
+    assert spm_anim.decimate_keyframes(frames, lrs, 1e-6) == knots
+
+
+def test_error_stays_within_tolerance():
+    frames = np.arange(1, 1001)
+    rng = np.random.default_rng(0)
+    phase = rng.uniform(0.0, 6.0, (20, 3))
+    locations = np.sin(frames[:, None, None] * 0.01 + phase)
+    lrs = make_locRotScale(locations)
+    angle = frames * 0.005
+    lrs[:, :, 3] = np.sin(angle)[:, None]
+    lrs[:, :, 6] = np.cos(angle)[:, None]
+
+    tolerance = 1e-3
+    kept = spm_anim.decimate_keyframes(frames, lrs, tolerance)
+    assert kept[0] == 0 and kept[-1] == len(frames) - 1
+    assert kept == sorted(set(kept))
+    assert len(kept) < len(frames) // 4
+    assert spm_anim.locRotScale_error(reconstruct(frames, lrs, kept), lrs) <= tolerance
+
+
+def test_static_animation_keeps_the_ends():
+    frames = np.arange(1, 3001)
+    lrs = make_locRotScale(np.ones((len(frames), 60, 3)))
+    assert spm_anim.decimate_keyframes(frames, lrs, 1e-4) == [0, len(frames) - 1]
@@ -0,0 +1,64 @@
+import os
+
+from spm_cache import SPMCache, new_key_hasher
+
+
+def write_file(path, content):
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_store_and_restore(tmp_path):
+    cache = SPMCache(str(tmp_path / "cache"), 1024)
+    exported = str(tmp_path / "exported.spm")
+    restored = str(tmp_path / "restored.spm")
+    assert not cache.restore("a", restored)
+    assert not os.path.exists(restored)
+
+    write_file(exported, b"SP spm content")
+    cache.store("a", exported)
+    assert cache.restore("a", restored)
+    assert read_file(restored) == b"SP spm content"
+    assert not cache.restore("b", restored)
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    cache = SPMCache(str(tmp_path / "cache"), 250)
+    exported = str(tmp_path / "exported.spm")
+    for key, age in (("a", 3000), ("b", 2000)):
+        write_file(exported, key.encode() * 100)
+        cache.store(key, exported)
+        os.utime(cache.get_path(key), (age, age))
+
+    # Restoring a makes b the least recently used entry
+    assert cache.restore("a", str(tmp_path / "restored.spm"))
+    write_file(exported, b"c" * 100)
+    cache.store("c", exported)
+    assert sorted(os.listdir(str(tmp_path / "cache"))) == ["a.spm", "c.spm"]
+
+    # An entry larger than the cache does not stay
+    write_file(exported, b"d" * 300)
+    cache.store("d", exported)
+    assert os.listdir(str(tmp_path / "cache")) == []
+
+
+def test_key_covers_settings_and_input_files(tmp_path):
+    materials = str(tmp_path / "materials.xml")
+    settings = {"export-normal": True, "cache-dir": "x"}
+
+    def key(export_settings, input_files=()):
+        return new_key_hasher(export_settings, input_files).hexdigest()
+
+    missing = key(settings, [materials])
+    assert key(settings) == key(dict(settings, **{"cache-dir": "y"}))
+    assert key(settings) != key(dict(settings, **{"export-normal": False}))
+    write_file(materials, b"")
+    assert key(settings, [materials]) != missing
+    empty = key(settings, [materials])
+    write_file(materials, b"<materials/>")
+    assert key(settings, [materials]) != empty
@@ -0,0 +1,261 @@
+import struct
+
+import numpy as np
+import pytest
+
+import spm_mesh
+
+
+def write_2101010_rev(vector3):
+    """
+    Scalar reference, the per vertex encoder the exporter used before
+    spm_mesh.pack_2101010_rev
+    """
+    part = 0
+    ret = 0
+    v = min(1.0, max(-1.0, vector3[0]))
+    if v > 0.0:
+        part = (int)((v * 511.0) + 0.5)
+    else:
+        part = (int)((v * 512.0) - 0.5)
+    ret |= part & 1023
+
+    v = min(1.0, max(-1.0, vector3[1]))
+    if v > 0.0:
+        part = (int)((v * 511.0) + 0.5)
+    else:
+        part = (int)((v * 512.0) - 0.5)
+    ret |= (part & 1023) << 10
+
+    v = min(1.0, max(-1.0, vector3[2]))
+    if v > 0.0:
+        part = (int)((v * 511.0) + 0.5)
+    else:
+        part = (int)((v * 512.0) - 0.5)
+    ret |= (part & 1023) << 20
+
+    if len(vector3) == 4:
+        v = min(1.0, max(-1.0, vector3[3]))
+        if v > 0.0:
+            part = (int)((v * 1.0) + 0.5)
+        else:
+            part = (int)((v * 2.0) - 0.5)
+    else:
+        part = 0
+    ret |= (part & 3) << 30
+    return ret
+
+
+def write_half_float(value):
+    """
+    Scalar reference, struct.pack("<e") saturating to infinity where it
+    raises OverflowError
+    """
+    if abs(value) >= 65520.0:
+        value = np.copysign(np.inf, value)
+    return struct.unpack("<H", struct.pack("<e", value))[0]
+
+
+def make_grid(size, vertex_offset=0):
+    """
+    Two triangles per cell of a size by size grid, in row order
+    """
+    v = np.arange((size + 1) * (size + 1)).reshape(size + 1, size + 1) + vertex_offset
+    a, b, c, d = v[:-1, :-1].ravel(), v[:-1, 1:].ravel(), v[1:, :-1].ravel(), v[1:, 1:].ravel()
+    return np.stack([np.stack([a, b, c], axis=1), np.stack([b, d, c], axis=1)], axis=1).reshape(-1, 3)
+
+
+def test_pack_half_float_matches_struct():
+    rng = np.random.default_rng(0)
+    edges = [0.0, -0.0, 1e-8, 65504.0, 65520.0, -1e9]
+    values = np.concatenate([rng.uniform(-70000.0, 70000.0, 500), rng.uniform(-1.0, 1.0, 500), edges])
+    expected = [write_half_float(v) for v in values.tolist()]
+    # Out of range values become infinity, numpy warns about them
+    with np.errstate(over="ignore"):
+        assert spm_mesh.pack_half_float(values).tolist() == expected
+
+
+def test_pack_2101010_rev_matches_scalar():
+    rng = np.random.default_rng(0)
+    vectors = rng.uniform(-1.2, 1.2, (1000, 4))
+    vectors[0] = [0.0, -0.0, 1.0, -1.0]
+    vectors[1] = [np.nan, 0.5, -0.5, 0.0]
+    for width in (3, 4):
+        expected = [write_2101010_rev(v) for v in vectors[:, 0:width].tolist()]
+        assert spm_mesh.pack_2101010_rev(vectors[:, 0:width]).tolist() == expected
+
+
+def test_unpack_2101010_rev_round_trip():
+    rng = np.random.default_rng(1)
+    vectors = rng.uniform(-1.0, 1.0, (1000, 4))
+    vectors[:, 3] = np.sign(vectors[:, 3])
+    unpacked = spm_mesh.unpack_2101010_rev(spm_mesh.pack_2101010_rev(vectors))
+    assert np.abs(unpacked[:, 0:3] - vectors[:, 0:3]).max() <= 1.0 / 511.0
+    assert unpacked[:, 3].tolist() == vectors[:, 3].tolist()
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_tipsify(shuffle):
+    rng = np.random.default_rng(0)
+    # Several grids sharing one buffer, as when meshes share a material
+    triangles = np.concatenate([make_grid(size, (size + 1) * (size + 1) * i) for i, size in enumerate([4, 20, 40])])
+    vertex_count = triangles.max() + 1
+    if shuffle:
+        triangles = triangles[rng.permutation(len(triangles))]
+    order = spm_mesh.tipsify(triangles.ravel(), vertex_count)
+    assert sorted(order.tolist()) == list(range(len(triangles)))
+
+    acmr_before = spm_mesh.average_cache_miss_ratio(triangles.ravel())
+    acmr_after = spm_mesh.average_cache_miss_ratio(triangles[order].ravel())
+    assert acmr_after <= acmr_before
+    assert acmr_after < 0.75
+
+
+def test_tipsify_triangle_soup():
+    rng = np.random.default_rng(1)
+    triangles = rng.integers(0, 300, (1000, 3))
+    order = spm_mesh.tipsify(triangles.ravel(), 300)
+    assert sorted(order.tolist()) == list(range(len(triangles)))
+    assert spm_mesh.average_cache_miss_ratio(triangles[order].ravel()) <= \
+        spm_mesh.average_cache_miss_ratio(triangles.ravel())
+
+
+def test_select_influences_matches_walk():
+    rng = np.random.default_rng(0)
+    vertex_count = 300
+    name_count = 12
+    in_names = rng.random(name_count) < 0.6
+    # Sorted by decreasing weight, ties keep the group order, like the
+    # exporter reads them
+    vertex_groups = []
+    for vertex in range(vertex_count):
+        names = rng.choice(name_count, rng.integers(0, 9), replace=False).tolist()
+        weights = rng.choice([0.1, 0.25, 0.5, 1.0], len(names)).tolist()
+        vertex_groups.append(sorted(zip(names, weights), key=lambda group: -group[1]))
+
+    influences = [(vertex, name, weight) for vertex, groups in enumerate(vertex_groups) for name, weight in groups]
+    influence_vertex, influence_name, influence_weight = (np.array(column) for column in zip(*influences))
+    vertex_names, vertex_weights = spm_mesh.select_influences(
+        influence_vertex, influence_name, influence_weight, vertex_count, in_names
+    )
+
+    # Walk of ExportArm.build_index before it was vectorized
+    for vertex, groups in enumerate(vertex_groups):
+        kept = [(name, weight) for name, weight in groups if in_names[name]][0:4]
+        padding = [(-1, 0.0)] * (4 - len(kept))
+        assert list(zip(vertex_names[vertex].tolist(), vertex_weights[vertex].tolist())) == kept + padding
+
+
+def walk_buffers(keys, max_vertices):
+    """
+    Dictionary walk of the exporter before split_buffer, a buffer is flushed
+    before the next triangle once it holds more than max_vertices vertices
+    """
+    rows = [tuple(row) for row in keys.tolist()]
+    buffers = []
+    start = 0
+    vertices = {}
+    vertex_corners = []
+    indices = []
+    for triangle in range(0, len(rows) // 3):
+        if len(vertices) > max_vertices:
+            buffers.append((start, triangle * 3, vertex_corners, indices))
+            start = triangle * 3
+            vertices = {}
+            vertex_corners = []
+            indices = []
+        for corner in range(triangle * 3, triangle * 3 + 3):
+            if rows[corner] not in vertices:
+                vertices[rows[corner]] = len(vertex_corners)
+                vertex_corners.append(corner)
+            indices.append(vertices[rows[corner]])
+    if indices:
+        buffers.append((start, len(rows), vertex_corners, indices))
+    return buffers
+
+
+def make_keys(rng, triangle_count, distinct):
+    position = rng.integers(0, distinct, (triangle_count * 3, 1)) * np.array([[1.0, 0.5, 0.25]])
+    normal = np.zeros((triangle_count * 3, 3))
+    normal[:, 2] = 1.0
+    color = np.full((triangle_count * 3, 3), 255)
+    all_uvs = rng.integers(0, 2, (triangle_count * 3, 4)) * 0.5
+    tangent = np.ones((triangle_count * 3, 4))
+    return spm_mesh.build_weld_keys(position, normal, color, all_uvs, tangent)
+
+
+def test_weld_numbers_vertices_in_first_use_order():
+    keys = make_keys(np.random.default_rng(0), 500, 200)
+    vertex_corners, indices = spm_mesh.weld(keys)
+    (_, _, expected_corners, expected_indices), = walk_buffers(keys, len(keys))
+    assert vertex_corners.tolist() == expected_corners
+    assert indices.tolist() == expected_indices
+
+
+@pytest.mark.parametrize("max_vertices", [10, 100, 1000])
+def test_split_buffer_matches_walk(max_vertices):
+    keys = make_keys(np.random.default_rng(max_vertices), 700, 400)
+    buffers = spm_mesh.split_buffer(keys, max_vertices)
+    expected = walk_buffers(keys, max_vertices)
+    assert len(buffers) == len(expected)
+    for (start, end, vertex_corners, indices), walked in zip(buffers, expected):
+        assert (start, end, vertex_corners.tolist(), indices.tolist()) == walked
+
+
+def test_split_buffer_flushes_over_65532_vertices():
+    # Unwelded triangles add 3 vertices each, the first buffer closes on the
+    # triangle taking it to 65535 vertices
+    keys = make_keys(np.random.default_rng(1), 30000, 10)
+    keys[:, 0] = np.arange(len(keys))
+    buffers = spm_mesh.split_buffer(keys)
+    assert [(start, end) for start, end, _, _ in buffers] == [(0, 65535), (65535, 90000)]
+    assert len(buffers[0][2]) == 65535
+    for (start, end, vertex_corners, indices), walked in zip(buffers, walk_buffers(keys, 65532)):
+        assert (start, end, vertex_corners.tolist(), indices.tolist()) == walked
+
+
+def test_partition_grid_matches_walk():
+    rng = np.random.default_rng(0)
+    centroids = rng.uniform(-50.0, 50.0, (2000, 3))
+    sector = spm_mesh.partition_grid(centroids, 20.0)
+
+    lower = centroids.min(axis=0)
+    cells = [tuple(int(c) for c in np.floor((centroid - lower) / 20.0)) for centroid in centroids]
+    expected = {cell: i for i, cell in enumerate(sorted(set(cells)))}
+    assert sector.tolist() == [expected[cell] for cell in cells]
+
+
+def walk_octree(grid, triangles, origin, size, max_triangles, leaves):
+    """
+    Recursive octree over the integer grid coordinates of the triangles,
+    children are visited in Z-order
+    """
+    if len(triangles) <= max_triangles or size == 1:
+        leaves.append(triangles)
+        return
+    half = size // 2
+    for child in range(0, 8):
+        child_origin = origin + half * np.array([child & 1, child >> 1 & 1, child >> 2 & 1])
+        inside = np.all((grid[triangles] >= child_origin) & (grid[triangles] < child_origin + half), axis=1)
+        if inside.any():
+            walk_octree(grid, triangles[inside], child_origin, half, max_triangles, leaves)
+
+
+@pytest.mark.parametrize("max_triangles", [1, 50, 400])
+def test_partition_octree_matches_walk(max_triangles):
+    rng = np.random.default_rng(max_triangles)
+    # Clustered so the leaves end up at different depths
+    centroids = np.concatenate([rng.normal(0.0, 1.0, (300, 3)), rng.uniform(-40.0, 40.0, (700, 3))])
+    max_depth = 5
+    sector = spm_mesh.partition_octree(centroids, max_triangles, max_depth)
+
+    lower = centroids.min(axis=0)
+    extent = (centroids.max(axis=0) - lower).max()
+    cells = 1 << max_depth
+    grid = np.clip(np.floor((centroids - lower) / extent * cells), 0, cells - 1).astype(np.int64)
+    leaves = []
+    walk_octree(grid, np.arange(len(centroids)), np.zeros(3, dtype=np.int64), cells, max_triangles, leaves)
+    expected = np.empty(len(centroids), dtype=np.int64)
+    for i, triangles in enumerate(leaves):
+        expected[triangles] = i
+    assert sector.tolist() == expected.tolist()
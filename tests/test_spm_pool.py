@@ -0,0 +1,18 @@
+import os
+
+import spm_pool
+
+
+def worker_pid(job):
+    return job, os.getpid()
+
+
+def test_small_work_runs_in_process():
+    results = list(spm_pool.map_jobs(worker_pid, list(range(10)), 0, spm_pool.MIN_PARALLEL_CORNERS - 1))
+    assert results == [(job, os.getpid()) for job in range(10)]
+
+
+def test_large_work_keeps_job_order():
+    jobs = list(range(50))
+    results = list(spm_pool.map_jobs(worker_pid, jobs, 2, spm_pool.MIN_PARALLEL_CORNERS))
+    assert [job for job, pid in results] == jobs
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import spm_reader
+from test_spm_writer import make_job, write_sectors
+
+# Normals and vertex colors
+FLAGS_BYTE = 1 | 1 << 1
+
+
+@pytest.mark.parametrize("triangle_count", [20, 2000])
+@pytest.mark.parametrize("pattern", ["runs", "alternating", "random"])
+def test_mixed_vertex_colors(tmp_path, triangle_count, pattern):
+    rng = np.random.default_rng(triangle_count)
+    if pattern == "runs":
+        white = np.repeat(rng.random(triangle_count // 10 + 1) < 0.5, 10)[0:triangle_count]
+    elif pattern == "alternating":
+        white = np.arange(triangle_count) % 2 == 0
+    else:
+        white = rng.random(triangle_count) < 0.5
+    colors = np.where(white[:, None], 255, rng.integers(0, 255, (triangle_count, 3)))
+    job = make_job(rng.uniform(-10.0, 10.0, (triangle_count * 3, 3)), optimize=False)
+    job["vcolor"] = True
+    job["color"] = np.repeat(colors, 3, axis=0).astype(np.uint8)
+
+    filename = str(tmp_path / "colors.spm")
+    write_sectors(filename, [job], FLAGS_BYTE)
+    with spm_reader.SPMFile(filename) as spm:
+        mesh_buffer, = spm.get_mesh_buffers()
+        positions = mesh_buffer.get_positions().tolist()
+        colors = mesh_buffer.get_colors().tolist()
+    expected = dict(zip(map(tuple, job["position"].tolist()), map(tuple, job["color"].tolist())))
+    assert dict(zip(map(tuple, positions), map(tuple, colors))) == expected
+
+
+def test_close_unmaps_the_file(tmp_path):
+    rng = np.random.default_rng(0)
+    filename = str(tmp_path / "close.spm")
+    write_sectors(filename, [make_job(rng.uniform(-10.0, 10.0, (30, 3)))])
+    with spm_reader.SPMFile(filename) as spm:
+        positions = spm.get_mesh_buffers()[0].get_positions().copy()
+    assert spm.m_mmap.closed
+    assert spm.get_mesh_buffers() == []
+    assert len(positions) > 0
+
+    # A view kept past close() keeps the mapping alive instead of failing
+    with spm_reader.SPMFile(filename) as spm:
+        view = spm.get_mesh_buffers()[0].m_vertices
+    assert not spm.m_mmap.closed
+    assert len(view.tobytes()) > 0
@@ -0,0 +1,79 @@
+import struct
+
+import numpy as np
+
+import spm_mesh
+import spm_reader
+from spm_writer import SPMWriter
+
+# SPMS, normals only
+TYPE_BYTE = 1 << 3
+FLAGS_BYTE = 1
+
+
+def make_job(position, optimize=True):
+    corner_count = len(position)
+    tangent = np.zeros((corner_count, 4), dtype=np.float64)
+    tangent[:, 3] = 1.0
+    normal = np.zeros((corner_count, 3), dtype=np.float64)
+    normal[:, 2] = 1.0
+    return {
+        "material_id": 0,
+        "position": np.asarray(position, dtype=np.float32),
+        "normal": normal,
+        "color": np.full((corner_count, 3), 255, dtype=np.uint8),
+        "all_uvs": np.zeros((corner_count, 4), dtype=np.float64),
+        "tangent": tangent,
+        "joints": np.full((corner_count, 4), -1, dtype=np.int16),
+        "weights": np.zeros((corner_count, 4), dtype=np.float64),
+        "uv_one": False,
+        "uv_two": False,
+        "vcolor": False,
+        "write_joints": False,
+        "export_tangent": False,
+        "export_normal": True,
+        "optimize": optimize,
+        "report_bounds": False
+    }
+
+
+def write_sectors(filename, jobs, flags_byte=FLAGS_BYTE):
+    with SPMWriter(filename) as spm:
+        spm.write_header(TYPE_BYTE, flags_byte)
+        spm.write_materials(["", ""])
+        spm.write(struct.pack("<H", len(jobs)))
+        for job in jobs:
+            spm.begin_mesh_buffers()
+            buffers, _ = spm_mesh.encode_material(job)
+            for data, positions in buffers:
+                spm.write_mesh_buffer(data, positions)
+            spm.end_mesh_buffers(write_bounding_box=True)
+        spm.write(struct.pack("<H", 0))
+
+
+def test_sector_of_degenerate_triangles(tmp_path):
+    triangle = [[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [0.0, 2.0, 0.0]]
+    # Two zero area triangles, optimizing culls both
+    degenerate = [[5.0, 5.0, 5.0]] * 3 + [[1.0, 1.0, 1.0], [2.0, 2.0, 2.0], [1.0, 1.0, 1.0]]
+    assert spm_mesh.encode_material(make_job(degenerate))[0] == []
+
+    filename = str(tmp_path / "sectors.spm")
+    write_sectors(filename, [make_job(triangle), make_job(degenerate)])
+
+    spm = spm_reader.SPMFile(filename)
+    assert spm.m_type == "SPMS"
+    assert [len(sector.m_mesh_buffers) for sector in spm.m_sectors] == [1, 0]
+    assert spm.m_sectors[0].m_bounding_box.tolist() == [[0.0, 0.0, 0.0], [1.0, 2.0, 0.0]]
+    assert spm.m_sectors[1].m_bounding_box.tolist() == [[0.0] * 3] * 2
+    # The degenerate sector does not grow the file bounding box
+    assert spm.m_bounding_box.tolist() == [[0.0, 0.0, 0.0], [1.0, 2.0, 0.0]]
+
+
+def test_only_degenerate_triangles(tmp_path):
+    filename = str(tmp_path / "empty.spm")
+    write_sectors(filename, [make_job([[3.0, 3.0, 3.0]] * 3)])
+
+    spm = spm_reader.SPMFile(filename)
+    assert len(spm.m_sectors) == 1
+    assert spm.m_sectors[0].m_mesh_buffers == []
+    assert spm.m_bounding_box.tolist() == [[0.0] * 3] * 2